@@ -1,5 +1,6 @@
 import os
 import qt
+import vtk
 
 import slicer
 from slicer.ScriptedLoadableModule import *
@@ -7,6 +8,7 @@ from slicer.util import VTKObservationMixin
 from PIL import ImageColor
 
 import SimpleITK as sitk
+import sitkUtils
 import numpy
 import random
 
@@ -16,6 +18,9 @@ import importlib
 from CACSLabelerLib.CalciumScore import CalciumScore
 from CACSLabelerLib.SettingsHandler import SettingsHandler
 from CACSLabelerLib.SegmentationProcessor import SegmentationProcessor
+from CACSLabelerLib.DatasetIndex import loadDatasetIndex
+from CACSLabelerLib.CasePrefetcher import CasePrefetcher
+from CACSLabelerLib.VolumeCache import loadVolumeCache
 
 #
 # CACSLabeler
@@ -96,6 +101,9 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.comparisonObserver1 = None #holds segmentation of first observer when comparing
         self.comparisonObserver2 = None #holds segmentation of second observer when comparing
         self.selectedComparableObserver = None
+        self.casePrefetcher = None #reads the next unlabeled images in the background
+        self.prefetchedCase = None #prefetched data of the loaded volume
+        self.loadedThresholdMask = None #(image node id, threshold mask) of the loaded volume
 
         #used to add dependencies that are not shipped with 3dSlicer!
         self.checkIfDependenciesAreInstalled()
@@ -177,8 +185,7 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         filename = self.loadedVolumeNode.GetName().split(".mhd")[0] + self.settingsHandler.getContentByKeys(["datasets", currentDataset, "observers", currentObserver, "labelFileSuffix"]) + ".nrrd"
 
-        referenceITK = sitk.ReadImage(os.path.join(referencePath, filename))
-        referenceArray = sitk.GetArrayViewFromImage(referenceITK)
+        referenceArray = self.readLabelArray(os.path.join(referencePath, filename))
 
         # Get the segmentation node (assuming it's the only one loaded)
         segmentationNode = slicer.mrmlScene.GetFirstNodeByClass('vtkMRMLSegmentationNode')
@@ -391,7 +398,15 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.createColorTable()
         properties = {'Name': filename}
 
-        self.loadedVolumeNode = slicer.util.loadVolume(os.path.join(imagesPath, filename), properties=properties)
+        self.prefetchedCase = self.takePrefetchedCase(filename, imagesPath)
+
+        if self.prefetchedCase is not None:
+            self.loadedVolumeNode = sitkUtils.PushVolumeToSlicer(self.prefetchedCase["image"], name=filename)
+
+            if self.loadedVolumeNode.GetDisplayNode() is None:
+                self.loadedVolumeNode.CreateDefaultDisplayNodes()
+        else:
+            self.loadedVolumeNode = slicer.util.loadVolume(os.path.join(imagesPath, filename), properties=properties)
         self.loadedVolumeNode.SetName(filename)
 
         slicer.util.setSliceViewerLayers(background=self.loadedVolumeNode)
@@ -412,6 +427,101 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.compareLabelsButton.enabled = False
         self.checkIfLabelCanBeCompared(filename)
 
+        self.prefetchNextUnlabeledImages(filename)
+
+    def prefetchLabelPath(self, filename):
+        # label of the other segmentation mode that runThreshold converts, same name as the label of the observer
+        differentLabelType = self.differentLabelType()
+
+        if differentLabelType is None:
+            return None
+
+        imagesPath, labelsPath, segmentationMode, sliceStepFile, exportFolder, dataset, observer, labelFileSuffix = self.selectedDatasetAndObserverSetting()
+        labelName = os.path.splitext(filename)[0] + labelFileSuffix + segmentationFileExtension
+
+        return os.path.join(differentLabelType["labelPath"], labelName)
+
+    def getCasePrefetcher(self):
+        # number of unlabeled images that are read ahead, 0 disables prefetching
+        prefetchCases = self.settingsHandler.getContentByKeys(["prefetchCases"])
+
+        if prefetchCases is None:
+            prefetchCases = 2
+
+        if int(prefetchCases) <= 0:
+            return None
+
+        volumeCache = self.getVolumeCache()
+
+        if self.casePrefetcher is None or self.casePrefetcher.maxCases != int(prefetchCases) or self.casePrefetcher.volumeCache is not volumeCache:
+            if self.casePrefetcher is not None:
+                self.casePrefetcher.shutdown()
+
+            self.casePrefetcher = CasePrefetcher(int(prefetchCases), lowerThresholdValue, volumeCache)
+
+        return self.casePrefetcher
+
+    def getVolumeCache(self):
+        # decoded images and labels of the session, 0 disables the cache
+        volumeCacheSize = self.settingsHandler.getContentByKeys(["volumeCacheSizeMB"])
+
+        if volumeCacheSize is None:
+            volumeCacheSize = 1024
+
+        return loadVolumeCache(int(volumeCacheSize) * 1024 * 1024)
+
+    def cleanup(self):
+        if self.casePrefetcher is not None:
+            self.casePrefetcher.shutdown()
+
+        ScriptedLoadableModuleWidget.cleanup(self)
+
+    def prefetchNextUnlabeledImages(self, filename):
+        casePrefetcher = self.getCasePrefetcher()
+
+        if casePrefetcher is None:
+            return
+
+        datasetSettings = self.selectedDatasetAndObserverSetting()
+        imagesPath = datasetSettings[0]
+
+        # the loaded image stays unlabeled until it is saved, the next click selects the following ones
+        names = [name for name in self.getImageList(datasetSettings)["unlabeledImages"] if name + imageFileExtension != filename]
+
+        casePrefetcher.prefetch([(os.path.join(imagesPath, name + imageFileExtension), self.prefetchLabelPath(name + imageFileExtension))
+                                 for name in names[:casePrefetcher.maxCases]])
+
+    def takePrefetchedCase(self, filename, imagesPath):
+        if self.casePrefetcher is None:
+            return None
+
+        return self.casePrefetcher.take(os.path.join(imagesPath, filename), self.prefetchLabelPath(filename))
+
+    def thresholdMask(self, imageNode):
+        # voxels of the OTHER segment, computed once per loaded image
+        if self.loadedThresholdMask is not None and self.loadedThresholdMask[0] == imageNode.GetID():
+            return self.loadedThresholdMask[1]
+
+        if self.prefetchedCase is not None and os.path.basename(self.prefetchedCase["imagePath"]) == imageNode.GetName():
+            mask = self.prefetchedCase["thresholdMask"]
+        else:
+            mask = slicer.util.arrayFromVolume(imageNode) >= lowerThresholdValue
+
+        self.loadedThresholdMask = (imageNode.GetID(), mask)
+        return mask
+
+    def readLabelArray(self, labelPath):
+        if self.prefetchedCase is not None and self.prefetchedCase["labelPath"] == labelPath and self.prefetchedCase["labelArray"] is not None:
+            return self.prefetchedCase["labelArray"]
+
+        # read only if it comes from the volume cache
+        volumeCache = self.getVolumeCache()
+
+        if volumeCache is not None:
+            return volumeCache.readArray(labelPath)
+
+        return sitk.GetArrayFromImage(sitk.ReadImage(labelPath))
+
     def onSelectNextUnlabeledImage(self):
         self.clearCurrentViewedNode(True)
         imageList = self.getImageList(self.selectedDatasetAndObserverSetting())
@@ -514,6 +624,9 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.labelsToBeChanged.text = ""
         self.ui.labelsToBeChanged.cursorPosition = 0
 
+        self.prefetchedCase = None
+        self.loadedThresholdMask = None
+
     def progressBarUpdate(self):
         images = self.getImageList(self.selectedDatasetAndObserverSetting())
         self.ui.progressBar.minimum = 0
@@ -597,11 +710,8 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         imagesPath, labelsPath, segmentationMode, sliceStepFile, exportFolder, dataset, observer, labelFileSuffix = self.selectedDatasetAndObserverSetting()
         segmentNamesToLabels = []
 
-        for key in self.settingsHandler.getContentByKeys(["labels", segmentationMode]):
-            value = self.settingsHandler.getContentByKeys(["labels", segmentationMode, key, "value"])
-            color = self.settingsHandler.getContentByKeys(["labels", segmentationMode, key, "color"])
-
-            segmentNamesToLabels.append((key, value, color))
+        for key, value in self.settingsHandler.getLabelValues(segmentationMode).items():
+            segmentNamesToLabels.append((key, value, self.settingsHandler.getLabelColor(segmentationMode, key)))
 
         self.colorTableNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLColorTableNode")
         self.colorTableNode.SetTypeToUser()
@@ -613,7 +723,7 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.colorTableNode.SetNamesInitialised(True)  # prevent automatic color name generation
         # import random
         for segmentName, labelValue, color in segmentNamesToLabels:
-            r,g,b = ImageColor.getcolor(color, "RGB")
+            r,g,b = color
             a = 1.0
             self.colorTableNode.SetColor(labelValue, segmentName, r, g, b, a)
 
@@ -656,6 +766,7 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
             volumeNode = slicer.mrmlScene.GetFirstNodeByClass('vtkMRMLLabelMapVolumeNode')
             slicer.util.exportNode(volumeNode, os.path.join(labelsPath, filename))
+            self.datasetIndex(self.selectedDatasetAndObserverSetting()).addLabel(filename)
 
             slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
             self.progressBarUpdate()
@@ -785,8 +896,8 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         compareObserverFilePath = os.path.join(compareObserverLabelpath, (file + compareObserverlabelFileSuffix + segmentationFileExtension))
 
         # import labels
-        labelCurrentObserver = sitk.GetArrayFromImage(sitk.ReadImage(currentObserverFilePath))
-        labelCompareObserver = sitk.GetArrayFromImage(sitk.ReadImage(compareObserverFilePath))
+        labelCurrentObserver = self.readLabelArray(currentObserverFilePath)
+        labelCompareObserver = self.readLabelArray(compareObserverFilePath)
 
         #Compare labels
         currentObserverSegmentationType = self.settingsHandler.getContentByKeys(["datasets", currentDataset, "observers", currentObserver, "segmentationMode"])
@@ -794,8 +905,8 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         processor = SegmentationProcessor()
 
-        labelCurrentObserver = processor.convert(labelCurrentObserver, currentObserverSegmentationType, self.comparisonSegmentationType)
-        labelCompareObserver = processor.convert(labelCompareObserver, compareObserverSegmentationType, self.comparisonSegmentationType)
+        labelCurrentObserver = processor.convert(labelCurrentObserver, currentObserverSegmentationType, self.comparisonSegmentationType, inPlace=False)
+        labelCompareObserver = processor.convert(labelCompareObserver, compareObserverSegmentationType, self.comparisonSegmentationType, inPlace=False)
 
         self.compareLabels(labelCurrentObserver, labelCompareObserver)
 
@@ -1053,8 +1164,8 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         # generate comparison mask
         # import labels
-        observer1SegmentationArray = sitk.GetArrayFromImage(sitk.ReadImage(observer1LabelPath))
-        observer2SegmentationArray = sitk.GetArrayFromImage(sitk.ReadImage(observer2LabelPath))
+        observer1SegmentationArray = self.readLabelArray(observer1LabelPath)
+        observer2SegmentationArray = self.readLabelArray(observer2LabelPath)
 
         # Compare labels
         observer1SegmentationType = self.settingsHandler.getContentByKeys(["datasets", dataset, "observers", self.comparisonObserver1, "segmentationMode"])
@@ -1086,14 +1197,14 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
                 observer1Segmentation = processor.convert(observer1SegmentationArray,
                                                                        observer1SegmentationType,
-                                                                       "SegmentLevelOnlyArteries")
+                                                                       "SegmentLevelOnlyArteries", inPlace=False)
 
                 observer2Segmentation = processor.convert(observer2SegmentationArray,
                                                                        observer2SegmentationType,
-                                                                       "SegmentLevelOnlyArteries")
+                                                                       "SegmentLevelOnlyArteries", inPlace=False)
 
-                self.loadLabelFromArray(observer1SegmentationArray, "Observer1", labelDescription)
-                self.loadLabelFromArray(observer2SegmentationArray, "Observer2", labelDescription)
+                self.loadLabelFromArray(observer1Segmentation, "Observer1", labelDescription)
+                self.loadLabelFromArray(observer2Segmentation, "Observer2", labelDescription)
 
                 labelDescription["MISMATCH"] = {
                     'value': 100,
@@ -1124,14 +1235,14 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
                 observer1Segmentation = processor.convert(observer1SegmentationArray,
                                                           observer1SegmentationType,
-                                                          "17SegmentOnlyArteries")
+                                                          "17SegmentOnlyArteries", inPlace=False)
 
                 observer2Segmentation = processor.convert(observer2SegmentationArray,
                                                           observer2SegmentationType,
-                                                          "17SegmentOnlyArteries")
+                                                          "17SegmentOnlyArteries", inPlace=False)
 
-                self.loadLabelFromArray(observer1SegmentationArray, "Observer1", labelDescription)
-                self.loadLabelFromArray(observer2SegmentationArray, "Observer2", labelDescription)
+                self.loadLabelFromArray(observer1Segmentation, "Observer1", labelDescription)
+                self.loadLabelFromArray(observer2Segmentation, "Observer2", labelDescription)
 
                 labelDescription["MISMATCH"] = {
                     'value': 100,
@@ -1163,12 +1274,12 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                     print("observer1")
                     processor = SegmentationProcessor()
                     observer1SegmentationArray = processor.convert(observer1SegmentationArray,
-                                                                   observer1SegmentationType, observer2SegmentationType)
+                                                                   observer1SegmentationType, observer2SegmentationType, inPlace=False)
                 elif observer2SegmentationType == "17Segment":
                     print("observer2")
                     processor = SegmentationProcessor()
                     observer2SegmentationArray = processor.convert(observer2SegmentationArray,
-                                                                   observer2SegmentationType, observer1SegmentationType)
+                                                                   observer2SegmentationType, observer1SegmentationType, inPlace=False)
 
                 labelDescription = self.settingsHandler.getContentByKeys(["labels", "ArteryLevelWithLM"]).copy()
 
@@ -1187,12 +1298,12 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                     print("observer1")
                     processor = SegmentationProcessor()
                     observer1SegmentationArray = processor.convert(observer1SegmentationArray,
-                                                                   observer1SegmentationType, observer2SegmentationType)
+                                                                   observer1SegmentationType, observer2SegmentationType, inPlace=False)
                 elif observer2SegmentationType == "SegmentLevel":
                     print("observer2")
                     processor = SegmentationProcessor()
                     observer2SegmentationArray = processor.convert(observer2SegmentationArray,
-                                                                   observer2SegmentationType, observer1SegmentationType)
+                                                                   observer2SegmentationType, observer1SegmentationType, inPlace=False)
 
                 labelDescription = self.settingsHandler.getContentByKeys(["labels", "ArteryLevelWithLM"]).copy()
 
@@ -1212,9 +1323,9 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     def createComparisonLabel(self, observer1Segmentation, observer2Segmentation, labelDescription):
         comparisonSegmentation = numpy.copy(observer1Segmentation)
 
-        # removes other label
-        observer1Segmentation[observer1Segmentation == 1] = 0
-        observer2Segmentation[observer2Segmentation == 1] = 0
+        # removes other label, the labels can be read only arrays of the volume cache
+        observer1Segmentation = numpy.where(observer1Segmentation == 1, 0, observer1Segmentation)
+        observer2Segmentation = numpy.where(observer2Segmentation == 1, 0, observer2Segmentation)
 
         #finding differences using binary label
         binaryLabel = numpy.where(numpy.equal(observer1Segmentation, observer2Segmentation) == True, 2, 1)
@@ -1237,6 +1348,8 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         segmentation = segmentationNode.GetSegmentation()
         displayNode = segmentationNode.GetDisplayNode()
 
+        labelIndices = self.labelIndices(comparisonSegmentation)
+
         for key in labelDescription:
             color = labelDescription[key]["color"]
             value = labelDescription[key]["value"]
@@ -1250,18 +1363,16 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             segment.SetColor(r / 255, g / 255, b / 255)
             displayNode.SetSegmentOpacity3D(key, 1)
 
-            segmentId = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName(key)
-            segmentArray = slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, key, imageNode)
-
             if key == "OTHER":
-                segmentArray[slicer.util.arrayFromVolume(imageNode) >= lowerThresholdValue] = 1
-                segmentArray[comparisonSegmentation > 1] = 0
+                indices = self.otherIndices(imageNode, comparisonSegmentation, 1, labelIndices.get(value))
+            else:
+                indices = labelIndices.get(value)
 
-            segmentArray[comparisonSegmentation == value] = 1  # create segment by simple thresholding of an image
-            slicer.util.updateSegmentBinaryLabelmapFromArray(segmentArray, segmentationNode, segmentId, imageNode)
+            if indices is not None:
+                self.updateSegmentFromIndices(indices, segmentationNode, key, imageNode, comparisonSegmentation.shape)
 
     def loadLabelFromArray(self, labelArray, labelName, labelDescription):
-        uniqueKeys = numpy.unique(labelArray)
+        labelIndices = self.labelIndices(labelArray)
 
         imageNode = slicer.util.getNode(self.loadedVolumeNode.GetName())
 
@@ -1280,7 +1391,7 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             r, g, b = ImageColor.getcolor(color, "RGB")
 
             #improves speed ! only transversing elements that a segmented!
-            if (value in uniqueKeys) or (key == "OTHER"):
+            if (value in labelIndices) or (key == "OTHER"):
                 if segmentation.GetSegment(key) is None:
                     segmentation.AddEmptySegment(key)
 
@@ -1289,67 +1400,57 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                 segment.SetColor(r / 255, g / 255, b / 255)  # red
                 displayNode.SetSegmentOpacity3D(key, 1)  # Set opacity of a single segment
 
-                segmentId = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName(key)
-                segmentArray = slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, key, imageNode)
-
                 if key == "OTHER":
-                    segmentArray[slicer.util.arrayFromVolume(imageNode) >= lowerThresholdValue] = 1
-                    segmentArray[labelArray > labelDescription[key]["value"]] = 0
+                    indices = self.otherIndices(imageNode, labelArray, value, labelIndices.get(value))
+                else:
+                    indices = labelIndices[value]
 
-                segmentArray[labelArray == value] = 1  # create segment by simple thresholding of an image
+                self.updateSegmentFromIndices(indices, segmentationNode, key, imageNode, labelArray.shape)
 
-                slicer.util.updateSegmentBinaryLabelmapFromArray(segmentArray, segmentationNode, segmentId, imageNode)
+    def labelIndices(self, labelArray):
+        # label value => flat voxel indices, from one sort of the labeled voxels instead of a comparison per label value
+        labeledIndices = numpy.flatnonzero(labelArray)
+        labels = labelArray.ravel()[labeledIndices]
 
-    def getImageList(self, datasetSettings):
-        self.checkIfDependenciesAreInstalled()
-        pandas = importlib.import_module('pandas')
+        if len(labels) == 0:
+            return {}
 
-        imagesPath, labelsPath, segmentationMode, sliceStepFile, exportFolder, dataset, observer, labelFileSuffix = datasetSettings
+        order = numpy.argsort(labels, kind="stable")
+        sortedLabels = labels[order]
+        sortedIndices = labeledIndices[order]
 
-        filterActive = False
-        allFiles = []
-        if self.settingsHandler.getContentByKeys(["datasets", dataset, "observers", observer, "includedImageFilter"]) != "":
-            filterActive = True
-            csv = pandas.read_csv(self.settingsHandler.getContentByKeys(["datasets", dataset, "observers", observer, "includedImageFilter"]))
-            allFiles = csv['Filename'].tolist()
+        starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(sortedLabels)) + 1))
+        ends = numpy.append(starts[1:], len(sortedLabels))
 
-        files = {"allImages": [], "unlabeledImages": []}
-        references = []
+        return {int(sortedLabels[start]): sortedIndices[start:end] for start, end in zip(starts, ends)}
 
-        for referenceFileName in sorted(filter(lambda x: os.path.isfile(os.path.join(labelsPath, x)),os.listdir(labelsPath))):
-            name, extension = os.path.splitext(referenceFileName)
+    def otherIndices(self, imageNode, labelArray, otherValue, otherLabelIndices=None):
+        # thresholded voxels that are not labeled with a higher label value and the voxels labeled as OTHER
+        mask = self.thresholdMask(imageNode) & (labelArray <= otherValue)
+        indices = numpy.flatnonzero(mask)
 
-            if labelFileSuffix:
-                nameWithoutSuffix = name.split(labelFileSuffix)[0]
-            else:
-                nameWithoutSuffix = name
+        if otherLabelIndices is not None:
+            indices = numpy.union1d(indices, otherLabelIndices)
 
-            if extension == segmentationFileExtension and os.path.isfile(os.path.join(imagesPath, nameWithoutSuffix + imageFileExtension)):
-               references.append(nameWithoutSuffix)
+        return indices
 
-        for imageFileName in sorted(filter(lambda x: os.path.isfile(os.path.join(imagesPath, x)),os.listdir(imagesPath))):
-            name, extension = os.path.splitext(imageFileName)
-            if extension == imageFileExtension:
-                if filterActive:
-                    fileName = name + extension
+    def updateSegmentFromIndices(self, indices, segmentationNode, segmentName, imageNode, shape):
+        segmentId = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName(segmentName)
 
-                    if fileName in allFiles:
-                        files["allImages"].append(name)
+        segmentArray = numpy.zeros(shape, dtype=numpy.uint8)
+        segmentArray.ravel()[indices] = 1
 
-                        try:
-                            references.index(name)
-                        except ValueError:
-                            files["unlabeledImages"].append(name)
+        slicer.util.updateSegmentBinaryLabelmapFromArray(segmentArray, segmentationNode, segmentId, imageNode)
 
-                else:
-                    files["allImages"].append(name)
+    def datasetIndex(self, datasetSettings):
+        imagesPath, labelsPath, segmentationMode, sliceStepFile, exportFolder, dataset, observer, labelFileSuffix = datasetSettings
+        includedImageFilter = self.settingsHandler.getContentByKeys(["datasets", dataset, "observers", observer, "includedImageFilter"])
 
-                    try:
-                        references.index(name)
-                    except ValueError:
-                        files["unlabeledImages"].append(name)
+        # kept between calls, only folders that changed are scanned again
+        return loadDatasetIndex(imagesPath, labelsPath, labelFileSuffix, includedImageFilter)
 
-        return files
+    def getImageList(self, datasetSettings):
+        return self.datasetIndex(datasetSettings).imageList()
 
     def onSaveComparisonLabel(self):
         #check if label is complete!
@@ -1379,6 +1480,7 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
             volumeNode = slicer.mrmlScene.GetFirstNodeByClass('vtkMRMLLabelMapVolumeNode')
             slicer.util.exportNode(volumeNode, os.path.join(savePath, filename))
+            self.datasetIndex(self.selectedDatasetAndObserverSetting()).addLabel(filename)
             slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
 
 
@@ -1423,148 +1525,130 @@ class CACSLabelerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             segmentation = segmentationNode.GetSegmentation()
             displayNode = segmentationNode.GetDisplayNode()
 
-            for key in self.settingsHandler.getContentByKeys(["labels", segmentationMode]):
-                color = self.settingsHandler.getContentByKeys(["labels", segmentationMode, key, "color"])
-
+            for key in self.settingsHandler.getLabelValues(segmentationMode):
                 if segmentation.GetSegment(key) is None:
                     segmentation.AddEmptySegment(key)
 
                 segment = segmentation.GetSegment(key)
 
-                r, g, b = ImageColor.getcolor(color, "RGB")
+                r, g, b = self.settingsHandler.getLabelColor(segmentationMode, key)
                 segment.SetColor(r / 255, g / 255, b / 255)  # red
                 displayNode.SetSegmentOpacity3D(key, 1)  # Set opacity of a single segment
 
-                if key == "OTHER" and not os.path.isfile(os.path.join(labelsPath, labelName)):
-                    segmentId = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName(key)
-                    segmentArray = slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, key, imageNode)
-                    segmentArray[slicer.util.arrayFromVolume(
-                        imageNode) >= lowerThresholdValue] = 1  # create segment by simple thresholding of an image
-                    slicer.util.updateSegmentBinaryLabelmapFromArray(segmentArray, segmentationNode, segmentId,
-                                                                     imageNode)
-
-            converter = SegmentationProcessor()
-
-            # converts label if other label is available
-            if differentLabelType is not None and not os.path.isfile(os.path.join(labelsPath, labelName)):
-                if os.path.isfile(os.path.join(differentLabelType["labelPath"], labelName)):
-                    label = sitk.ReadImage(os.path.join(differentLabelType["labelPath"], labelName))
-                    labelArray = sitk.GetArrayFromImage(label)
-
-                    if differentLabelType["labelSegmentationMode"] == segmentationMode:
-                        for key in self.settingsHandler.getContentByKeys(["labels", segmentationMode]):
-
-                            if key != "OTHER":
-                                self.convertLabelType(labelArray, converter.getLabelValueByName(segmentationMode, key), key, imageNode, segmentationNode)
-
-                    if differentLabelType["labelSegmentationMode"] == "ArteryLevelWithLM" and segmentationMode == "SegmentLevel":
-                        self.convertLabelType(labelArray, 5, 'LM_BRANCH', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, 2, 'LAD_PROXIMAL', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, 4, "RCA_PROXIMAL", imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, 3, "LCX_PROXIMAL", imageNode, segmentationNode)
-
-                    if differentLabelType["labelSegmentationMode"] == "ArteryLevelWithLM" and segmentationMode == "17Segment":
-                        self.convertLabelType(labelArray, 5, 'LM', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, 2, 'LAD_PROXIMAL', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, 4, "RCA_PROXIMAL", imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, 3, "LCX_PROXIMAL", imageNode, segmentationNode)
-
-                    if differentLabelType["labelSegmentationMode"] == "SegmentLevel" and segmentationMode == "17Segment":
-                        oldType = "SegmentLevel"
-
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "RCA_PROXIMAL"),
-                                              'RCA_PROXIMAL', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "RCA_MID"),
-                                              'RCA_MID', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "RCA_DISTAL"),
-                                              'RCA_DISTAL', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "RCA_SIDE_BRANCH"),
-                                              'RCA_SIDE_PROXIMAL', imageNode, segmentationNode)
-
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "LM_BIF_LAD_LCX"),
-                                              'LM', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "LM_BIF_LAD"),
-                                              'LM', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "LM_BIF_LCX"),
-                                              'LM', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "LM_BRANCH"),
-                                              'LM', imageNode, segmentationNode)
-
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "LAD_PROXIMAL"),
-                                              'LAD_PROXIMAL', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "LAD_MID"),
-                                              'LAD_MID', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "LAD_DISTAL"),
-                                              'LAD_DISTAL', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "LAD_SIDE_BRANCH"),
-                                              'LAD_SIDE_D1', imageNode, segmentationNode)
-
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "LCX_PROXIMAL"),
-                                              'LCX_PROXIMAL', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "LCX_MID"),
-                                              'LCX_MID', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "LCX_DISTAL"),
-                                              'LCX_DISTAL', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "LCX_SIDE_BRANCH"),
-                                              'LCX_SIDE_OM1', imageNode, segmentationNode)
-
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "RIM"),
-                                              'RIM', imageNode, segmentationNode)
-
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "AORTA_ASC"),
-                                              'AORTA_ASC', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "AORTA_DSC"),
-                                              'AORTA_DSC', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "AORTA_ARC"),
-                                              'AORTA_ARC', imageNode, segmentationNode)
-
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "VALVE_AORTIC"),
-                                              'VALVE_AORTIC', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "VALVE_PULMONIC"),
-                                              'VALVE_PULMONIC', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "VALVE_TRICUSPID"),
-                                              'VALVE_TRICUSPID', imageNode, segmentationNode)
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "VALVE_MITRAL"),
-                                              'VALVE_MITRAL', imageNode, segmentationNode)
-
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "PAPILLAR_MUSCLE"),
-                                              'PAPILLAR_MUSCLE', imageNode, segmentationNode)
-
-                        self.convertLabelType(labelArray, converter.getLabelValueByName(oldType, "NFS_CACS"),
-                                              'NFS_CACS', imageNode, segmentationNode)
-
-                        # Adding Text
-                        Text = ""
-
-                        elements = numpy.unique(labelArray)
-
-                        if converter.getLabelValueByName(oldType, 'LAD_SIDE_BRANCH') in elements:
-                            Text = Text + " LAD_SIDE "
-
-                        if converter.getLabelValueByName(oldType, 'LCX_SIDE_BRANCH') in elements:
-                            Text = Text + " LCX_SIDE "
-
-                        if converter.getLabelValueByName(oldType, 'LCX_DISTAL') in elements:
-                            Text = Text + " LCX_DISTAL "
-
-                        if converter.getLabelValueByName(oldType, 'RCA_SIDE_BRANCH') in elements:
-                            Text = Text + " RCA_SIDE "
-
-                        if converter.getLabelValueByName(oldType, 'RCA_DISTAL') in elements:
-                            Text = Text + " RCA_DISTAL "
-
-                        self.ui.labelsToBeChanged.text = Text
-                        self.ui.labelsToBeChanged.cursorPosition = 0
-
-    def convertLabelType(self, oldLabelArray, oldArrayId, segmentIdName, imageNode, segmentationNode):
-        segmentId = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName(segmentIdName)
-        otherId = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName('OTHER')
+            # a new label is built as one label array and imported into the segments at once
+            if not os.path.isfile(os.path.join(labelsPath, labelName)):
+                labelArray = None
+                conversions = []
 
-        segmentArray = slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, segmentId, imageNode)
-        segmentArray[oldLabelArray == oldArrayId] = 1
+                # converts label if other label is available
+                if differentLabelType is not None and os.path.isfile(os.path.join(differentLabelType["labelPath"], labelName)):
+                    labelArray = self.readLabelArray(os.path.join(differentLabelType["labelPath"], labelName))
+                    conversions = self.labelConversions(differentLabelType["labelSegmentationMode"], segmentationMode)
 
-        otherArray = slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, otherId, imageNode)
-        otherArray[oldLabelArray == oldArrayId] = 0
+                newLabelArray = self.createLabelArray(imageNode, segmentationMode, labelArray, conversions)
+                self.importLabelArray(newLabelArray, imageNode, segmentationNode, segmentationMode)
 
-        slicer.util.updateSegmentBinaryLabelmapFromArray(segmentArray, segmentationNode, segmentId, imageNode)
-        slicer.util.updateSegmentBinaryLabelmapFromArray(otherArray, segmentationNode, otherId, imageNode)
\ No newline at end of file
+                if labelArray is not None and differentLabelType["labelSegmentationMode"] == "SegmentLevel" and segmentationMode == "17Segment":
+                    converter = SegmentationProcessor()
+                    oldType = "SegmentLevel"
+
+                    # Adding Text
+                    Text = ""
+
+                    elements = numpy.unique(labelArray)
+
+                    if converter.getLabelValueByName(oldType, 'LAD_SIDE_BRANCH') in elements:
+                        Text = Text + " LAD_SIDE "
+
+                    if converter.getLabelValueByName(oldType, 'LCX_SIDE_BRANCH') in elements:
+                        Text = Text + " LCX_SIDE "
+
+                    if converter.getLabelValueByName(oldType, 'LCX_DISTAL') in elements:
+                        Text = Text + " LCX_DISTAL "
+
+                    if converter.getLabelValueByName(oldType, 'RCA_SIDE_BRANCH') in elements:
+                        Text = Text + " RCA_SIDE "
+
+                    if converter.getLabelValueByName(oldType, 'RCA_DISTAL') in elements:
+                        Text = Text + " RCA_DISTAL "
+
+                    self.ui.labelsToBeChanged.text = Text
+                    self.ui.labelsToBeChanged.cursorPosition = 0
+
+    def labelConversions(self, oldSegmentationMode, segmentationMode):
+        # (label value in the other label, segment name), a later conversion of the same voxel wins
+        converter = SegmentationProcessor()
+        conversions = []
+
+        if oldSegmentationMode == segmentationMode:
+            for key in self.settingsHandler.getContentByKeys(["labels", segmentationMode]):
+                if key != "OTHER":
+                    conversions.append((converter.getLabelValueByName(segmentationMode, key), key))
+
+        if oldSegmentationMode == "ArteryLevelWithLM" and segmentationMode == "SegmentLevel":
+            conversions += [(5, 'LM_BRANCH'), (2, 'LAD_PROXIMAL'), (4, "RCA_PROXIMAL"), (3, "LCX_PROXIMAL")]
+
+        if oldSegmentationMode == "ArteryLevelWithLM" and segmentationMode == "17Segment":
+            conversions += [(5, 'LM'), (2, 'LAD_PROXIMAL'), (4, "RCA_PROXIMAL"), (3, "LCX_PROXIMAL")]
+
+        if oldSegmentationMode == "SegmentLevel" and segmentationMode == "17Segment":
+            segmentNames = [("RCA_PROXIMAL", 'RCA_PROXIMAL'), ("RCA_MID", 'RCA_MID'), ("RCA_DISTAL", 'RCA_DISTAL'), ("RCA_SIDE_BRANCH", 'RCA_SIDE_PROXIMAL'),
+                            ("LM_BIF_LAD_LCX", 'LM'), ("LM_BIF_LAD", 'LM'), ("LM_BIF_LCX", 'LM'), ("LM_BRANCH", 'LM'),
+                            ("LAD_PROXIMAL", 'LAD_PROXIMAL'), ("LAD_MID", 'LAD_MID'), ("LAD_DISTAL", 'LAD_DISTAL'), ("LAD_SIDE_BRANCH", 'LAD_SIDE_D1'),
+                            ("LCX_PROXIMAL", 'LCX_PROXIMAL'), ("LCX_MID", 'LCX_MID'), ("LCX_DISTAL", 'LCX_DISTAL'), ("LCX_SIDE_BRANCH", 'LCX_SIDE_OM1'),
+                            ("RIM", 'RIM'),
+                            ("AORTA_ASC", 'AORTA_ASC'), ("AORTA_DSC", 'AORTA_DSC'), ("AORTA_ARC", 'AORTA_ARC'),
+                            ("VALVE_AORTIC", 'VALVE_AORTIC'), ("VALVE_PULMONIC", 'VALVE_PULMONIC'), ("VALVE_TRICUSPID", 'VALVE_TRICUSPID'), ("VALVE_MITRAL", 'VALVE_MITRAL'),
+                            ("PAPILLAR_MUSCLE", 'PAPILLAR_MUSCLE'),
+                            ("NFS_CACS", 'NFS_CACS')]
+
+            conversions += [(converter.getLabelValueByName(oldSegmentationMode, oldName), newName) for oldName, newName in segmentNames]
+
+        return conversions
+
+    def createLabelArray(self, imageNode, segmentationMode, labelArray=None, conversions=[]):
+        # OTHER by thresholding the image, converted voxels of the other label replace it
+        labelValues = self.settingsHandler.getLabelValues(segmentationMode)
+        newLabelArray = numpy.zeros(slicer.util.arrayFromVolume(imageNode).shape, dtype=numpy.min_scalar_type(max(labelValues.values())))
+
+        if "OTHER" in labelValues:
+            newLabelArray[self.thresholdMask(imageNode)] = labelValues["OTHER"]
+
+        if labelArray is not None and len(conversions) > 0:
+            # one lookup table for all conversions instead of a comparison of the label per converted value
+            if labelArray.dtype.kind not in "iu":
+                # e.g. float labels of a resampled label file, only integral values are converted
+                integral = numpy.isfinite(labelArray) & (numpy.round(labelArray) == labelArray)
+                labelArray = numpy.where(integral, labelArray, 0).astype(numpy.intp)
+
+            if labelArray.dtype.kind != "u":
+                labelArray = numpy.clip(labelArray, 0, None)
+
+            lookupTable = numpy.zeros(int(labelArray.max()) + 1, dtype=newLabelArray.dtype)
+
+            for oldValue, name in conversions:
+                if oldValue is not None and 0 <= oldValue < len(lookupTable) and name in labelValues:
+                    lookupTable[oldValue] = labelValues[name]
+
+            convertedArray = lookupTable[labelArray]
+            converted = convertedArray > 0
+            newLabelArray[converted] = convertedArray[converted]
+
+        return newLabelArray
+
+    def importLabelArray(self, labelArray, imageNode, segmentationNode, segmentationMode):
+        # label value i is imported into the segment with that value in one labelmap import
+        segmentation = segmentationNode.GetSegmentation()
+        segmentIdsByValue = {value: segmentation.GetSegmentIdBySegmentName(name) for name, value in self.settingsHandler.getLabelValues(segmentationMode).items()}
+
+        segmentIds = vtk.vtkStringArray()
+
+        for value in range(1, max(segmentIdsByValue) + 1):
+            segmentIds.InsertNextValue(segmentIdsByValue.get(value, ""))
+
+        labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+        labelmapVolumeNode.CopyOrientation(imageNode)
+        slicer.util.updateVolumeFromArray(labelmapVolumeNode, labelArray)
+
+        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapVolumeNode, segmentationNode, segmentIds)
+        slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
\ No newline at end of file
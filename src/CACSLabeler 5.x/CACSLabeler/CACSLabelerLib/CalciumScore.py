@@ -3,11 +3,21 @@ import os
 import json
 import numpy
 import concurrent.futures
+import collections
+import glob
+import queue
+import re
+import threading
+import zlib
 import SimpleITK as sitk
 from scipy.ndimage import label
 from scipy import ndimage as ndi
 
 from .SettingsHandler import SettingsHandler
+from .ResultCache import ResultCache
+from .SegmentationProcessor import remapSegmentation
+from .SliceStepIndex import loadSliceStepIndex
+from .VolumeCache import currentVolumeCache
 
 class NumpyJsonEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -19,30 +29,263 @@ class NumpyJsonEncoder(json.JSONEncoder):
             return obj.tolist()
         return super(NumpyJsonEncoder, self).default(obj)
 
+class ExportJournal():
+    # Append-only export: one csv row and one json line per finished series. The json lines file is the journal
+    # an interrupted export is resumed from, it is removed after the final csv and json have been written.
+    def __init__(self, csvPath, journalPath, fsyncInterval):
+        self.csvPath = csvPath
+        self.journalPath = journalPath
+        self.fsyncInterval = fsyncInterval
+
+        self.csvFile = None
+        self.journalFile = None
+        self.unsyncedRecords = 0
+
+        self.pandas = importlib.import_module('pandas')
+
+    def readRecords(self):
+        records = []
+
+        if os.path.isfile(self.journalPath):
+            with open(self.journalPath, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # last line of an interrupted export may be incomplete
+                        pass
+
+        return records
+
+    def open(self, records):
+        # rewrites csv and journal from the resumed records, any partially written row is dropped
+        # the rewritten files replace the old ones only when complete, an interruption while resuming keeps the old journal
+        temporaryCsvPath = self.csvPath + ".tmp"
+        temporaryJournalPath = self.journalPath + ".tmp"
+
+        self.csvFile = open(temporaryCsvPath, 'w', encoding='utf-8', newline='')
+        self.journalFile = open(temporaryJournalPath, 'w', encoding='utf-8')
+
+        for record in records:
+            self.append(record)
+
+        self.sync()
+        self.csvFile.close()
+        self.journalFile.close()
+
+        os.replace(temporaryJournalPath, self.journalPath)
+        os.replace(temporaryCsvPath, self.csvPath)
+
+        self.csvFile = open(self.csvPath, 'a', encoding='utf-8', newline='')
+        self.journalFile = open(self.journalPath, 'a', encoding='utf-8')
+
+    def append(self, record):
+        dataframe = self.pandas.DataFrame.from_records([record["result"]])
+        dataframe.to_csv(self.csvFile, header=self.csvFile.tell() == 0, index=False, sep=';', float_format='%.3f')
+
+        self.journalFile.write(json.dumps(record, ensure_ascii=False, cls=NumpyJsonEncoder) + "\n")
+
+        self.unsyncedRecords += 1
+        if self.unsyncedRecords >= self.fsyncInterval:
+            self.sync()
+
+    def sync(self):
+        for file in (self.csvFile, self.journalFile):
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.unsyncedRecords = 0
+
+    def close(self):
+        if self.csvFile is not None:
+            self.sync()
+            self.csvFile.close()
+            self.journalFile.close()
+
+        self.csvFile = None
+        self.journalFile = None
+
+    def writeJson(self, jsonPath):
+        # writes the final export json from the journal, same content and layout as json.dump of the grouped series
+        # only the journal offsets of the series are held in memory
+        patientOffsets = {}
+
+        with open(self.journalPath, 'rb') as journal:
+            offset = 0
+
+            for line in journal:
+                try:
+                    patientOffsets.setdefault(json.loads(line)["patientID"], []).append(offset)
+                except json.JSONDecodeError:
+                    pass
+
+                offset += len(line)
+
+            with open(jsonPath, 'w', encoding='utf-8') as file:
+                if len(patientOffsets) == 0:
+                    file.write("{}")
+                    return
+
+                file.write("{\n")
+
+                for patientNumber, (patientID, offsets) in enumerate(patientOffsets.items()):
+                    file.write("    " + json.dumps(patientID, ensure_ascii=False) + ": {\n")
+
+                    for seriesNumber, seriesOffset in enumerate(offsets):
+                        journal.seek(seriesOffset)
+                        record = json.loads(journal.readline())
+
+                        seriesText = json.dumps(record["series"], ensure_ascii=False, indent=4, cls=NumpyJsonEncoder)
+                        file.write("        " + json.dumps(record["seriesInstanceUID"], ensure_ascii=False) + ": " + seriesText.replace("\n", "\n        "))
+                        file.write(",\n" if seriesNumber < len(offsets) - 1 else "\n")
+
+                    file.write("    }" + (",\n" if patientNumber < len(patientOffsets) - 1 else "\n"))
+
+                file.write("}")
+
+    def remove(self):
+        self.close()
+
+        if os.path.isfile(self.journalPath):
+            os.remove(self.journalPath)
+
+# One row per lesion, slice, 2d component and label. Component 0 marks slices in which the lesion is not split in 2d,
+# all labels of such a slice share the maximum attenuation of the whole slice.
+lesionTableDtype = numpy.dtype([
+    ("lesion", numpy.int32),
+    ("slice", numpy.int32),
+    ("component", numpy.int32),
+    ("label", numpy.int32),
+    ("voxelCount", numpy.int32),
+    ("maxAttenuation", numpy.float64)
+])
+
+# (lower HU bound, weight) of the Agatston density factor, lesions below the first bound are not scored
+agatstonDensityBands = [(130, 1), (200, 2), (300, 3), (400, 4)]
+
+# segmentation modes from coarse to fine, a segmentation mode can only be exported as itself or a coarser type
+exportTypesOrder = ["ArteryLevel", "ArteryLevelWithLM", "SegmentLevelDLNExport", "SegmentLevel", "17Segment"]
+
+# image, label and temporary arrays of findLesions/lesionPositionList per voxel, used for the export chunk size
+bytesPerVoxelEstimate = 40
+
+class MemoryBudget():
+    # limits the estimated memory of the series between reading and the end of their computation
+    def __init__(self, budgetInBytes):
+        self.budgetInBytes = budgetInBytes
+        self.usedBytes = 0
+        self.condition = threading.Condition()
+
+    def fits(self, size):
+        # a series larger than the whole budget is still processed, alone
+        return self.usedBytes == 0 or self.usedBytes + size <= self.budgetInBytes
+
+    def acquire(self, size):
+        with self.condition:
+            self.condition.wait_for(lambda: self.fits(size))
+            self.usedBytes += size
+
+    def release(self, size):
+        with self.condition:
+            self.usedBytes -= size
+            self.condition.notify_all()
+
+workerCalciumScore = None
+workerSliceStepIndex = None
+
+def initializeExportWorker(calciumScore, sliceStepIndex):
+    global workerCalciumScore, workerSliceStepIndex
+
+    workerCalciumScore = calciumScore
+    workerSliceStepIndex = sliceStepIndex
+
+def processImagesInWorker(filename):
+    return workerCalciumScore.processImages(filename, workerSliceStepIndex)
+
+def shardOfFilename(filename, shardCount):
+    # crc32 is stable across runs and machines, unlike hash()
+    return zlib.crc32(filename.encode('utf-8')) % shardCount
+
+def calciumRegion(labelArray):
+    # bounding box of all labels >= 2, the label conversions never move other voxels into it, None without labels
+    boundingBoxes = ndi.find_objects((labelArray >= 2).view(numpy.uint8))
+
+    if len(boundingBoxes) == 0:
+        return None
+
+    return boundingBoxes[0]
+
+def availableMemoryInBytes():
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
 class CalciumScore():
-    def __init__(self, datasetInformation):
+    def __init__(self, datasetInformation, exportType=None, settingsHandler=None, shard=None, fileList=None, partName=None,
+                 derivedExportTypes=None, observerDatasetInformations=None):
         imagesPath, labelsPath, segmentationMode, sliceStepFile, exportFolder, dataset, observer, fileSuffix = datasetInformation
 
-        self.settingsHandler = SettingsHandler()
+        self.settingsHandler = settingsHandler if settingsHandler is not None else SettingsHandler()
+
+        if exportType is None:
+            exportType = self.settingsHandler.getContentByKeys(["exportType"])
 
         self.segmentationMode = segmentationMode
         self.dataset = dataset
+        self.observer = observer
         self.fileSuffix = fileSuffix
 
-        exportTypesOrder = ["ArteryLevel", "ArteryLevelWithLM", "SegmentLevelDLNExport", "SegmentLevel", "17Segment"]
-
-        if exportTypesOrder.index(segmentationMode) >= exportTypesOrder.index(self.settingsHandler.getContentByKeys(["exportType"])):
-            self.exportType = self.settingsHandler.getContentByKeys(["exportType"])
+        if exportTypesOrder.index(segmentationMode) >= exportTypesOrder.index(exportType):
+            self.exportType = exportType
 
         else:
             self.exportType = segmentationMode
 
+        # sharded export: shard = (index, count) selects filenames by shardOfFilename, fileList selects them explicitly
+        # every part writes its own partial csv/json, which are combined by mergePartialExports
+        self.shard = shard
+        self.fileList = fileList
+
+        # derived export types are calculated from the same image and label read, each writes its own csv/json
+        self.derivedExports = []
+
+        for derivedExportType in derivedExportTypes or []:
+            derivedExport = CalciumScore(datasetInformation, exportType=derivedExportType, settingsHandler=self.settingsHandler,
+                                         shard=shard, fileList=fileList, partName=partName)
+
+            if derivedExport.exportType not in [self.exportType] + [export.exportType for export in self.derivedExports]:
+                self.derivedExports.append(derivedExport)
+
+        # other observers of the dataset, their label files are scored with the same image read, each writes its own csv/json
+        # with observers the export runs over image names, labelFilenames maps them to the label file of each observer
+        self.observerExports = []
+        self.labelFilenames = None
+
+        for observerDatasetInformation in observerDatasetInformations or []:
+            self.observerExports.append(CalciumScore(observerDatasetInformation, exportType=exportType, settingsHandler=self.settingsHandler,
+                                                     shard=shard, fileList=fileList, partName=partName, derivedExportTypes=derivedExportTypes))
+
+        if shard is not None:
+            partName = "part-" + str(shard[0]) + "-of-" + str(shard[1])
+        elif fileList is not None:
+            partName = "part-" + (partName or "files")
+
+        self.exportBaseName = os.path.join(exportFolder, dataset + "_" + observer + "_" + self.exportType)
+        exportName = self.exportBaseName if partName is None else self.exportBaseName + "." + partName
+
+        # long-format table of all observers and export types of a multi-observer export
+        observersName = os.path.join(exportFolder, dataset + "_observers")
+        observersName = observersName if partName is None else observersName + "." + partName
+
         self.filepaths = {
             "imageFolder": imagesPath,
             "referenceFolder": labelsPath,
             "sliceStepFile": sliceStepFile,
-            "exportFileCSV": os.path.join(exportFolder, dataset + "_" + observer + "_" + self.exportType + ".csv"),
-            "exportFileJSON": os.path.join(exportFolder, dataset + "_" + observer + "_" + self.exportType + ".json")
+            "exportFileCSV": exportName + ".csv",
+            "exportFileJSON": exportName + ".json",
+            "exportJournal": exportName + ".jsonl",
+            "exportFileObserversCSV": observersName + ".csv"
         }
 
         self.Items = self.createItems()
@@ -56,31 +299,47 @@ class CalciumScore():
         self.exportJson = {}
         self.exportList = []
 
+        # columnar lesion-slice table per (patientID, seriesInstanceUID), see lesionTableDtype
+        self.lesionTables = {}
+
+        # further Agatston thresholds and density bands, scored from the same lesion table as Agatston_
+        self.agatstonSweep = self.createAgatstonSweep()
+
+        self.exportJournal = None
+        self.resultCache = self.createResultCache(exportFolder)
+
         self.pandas = importlib.import_module('pandas')
 
-    def createItems(self):
-        items = None
+    def createResultCache(self, exportFolder):
+        # cached lesion tables of unchanged series are reused by later exports
+        if self.settingsHandler.getContentByKeys(["exportCache"]) is False:
+            return None
 
-        generatedItems = {}
+        cacheFolder = self.settingsHandler.getContentByKeys(["exportCacheFolder"]) or os.path.join(exportFolder, "cache")
+        cacheSize = self.settingsHandler.getContentByKeys(["exportCacheSizeMB"]) or 1024
+        useHash = self.settingsHandler.getContentByKeys(["exportCacheHash"]) is True
 
-        for item in self.settingsHandler.getContentByKeys(["exportedLabels", self.exportType]):
-            itemContent = None
+        return ResultCache(cacheFolder, cacheSize * 1024 * 1024, useHash)
 
-            labelContent = self.settingsHandler.getContentByKeys(["exportedLabels", self.exportType, item])
+    def createAgatstonSweep(self):
+        # setting agatstonSweep: [{"name": "100HU", "threshold": 100}, {"name": "custom", "densityBands": [[110, 1], [200, 2]]}, ...]
+        # a threshold alone keeps the default weights and only lowers the first band, density bands alone start at their first bound
+        agatstonSweep = []
 
-            if isinstance(labelContent, list):
-                itemContent = []
+        for configuration in self.settingsHandler.getContentByKeys(["agatstonSweep"]) or []:
+            densityBands = sorted((bound, weight) for bound, weight in configuration.get("densityBands", agatstonDensityBands))
+            threshold = configuration.get("threshold", densityBands[0][0])
 
-                for groupElement in labelContent:
-                    itemContent.append(self.settingsHandler.getContentByKeys(["labels", self.exportType, groupElement, "value"]))
+            if "densityBands" not in configuration and threshold < densityBands[0][0]:
+                densityBands[0] = (threshold, densityBands[0][1])
 
-            else:
-                itemContent = self.settingsHandler.getContentByKeys(["labels", self.exportType, labelContent, "value"])
-                pass
+            agatstonSweep.append({"name": str(configuration.get("name", threshold)), "threshold": threshold, "densityBands": densityBands})
 
-            generatedItems[item] = itemContent
+        return agatstonSweep
 
-        return generatedItems
+    def createItems(self):
+        # label value per exported item, groups are arrays of label values
+        return dict(self.settingsHandler.getExportedLabelValues(self.exportType))
 
     def exportFromJSONFile(self):
         # Opening JSON file
@@ -94,8 +353,10 @@ class CalciumScore():
             # list
             for patientId in self.exportJson:
                 for seriesInstanceUID in self.exportJson[patientId]:
+                    lesionsJson = self.exportJson[patientId][seriesInstanceUID].pop("lesions")
+                    self.lesionTables[(patientId, seriesInstanceUID)] = self.lesionTableFromJson(lesionsJson)
 
-                    result = self.calculateScore(patientId, seriesInstanceUID)
+                    result = self.calculateScore(patientId, seriesInstanceUID, self.exportJson[patientId][seriesInstanceUID], self.lesionTables[(patientId, seriesInstanceUID)])
                     self.exportList.append(result)
                     print("Exported", patientId, seriesInstanceUID)
 
@@ -107,20 +368,499 @@ class CalciumScore():
 
         if createJson:
             with open(self.filepaths["exportFileJSON"], 'w', encoding='utf-8') as file:
+                exportJson = {}
+
+                for patientID in self.exportJson:
+                    exportJson[patientID] = {}
+
+                    for seriesInstanceUID in self.exportJson[patientID]:
+                        exportJson[patientID][seriesInstanceUID] = self.seriesJson(patientID, seriesInstanceUID)
+
                 #Numpy encoder ensures that numpy types can be exported using dump!
-                json.dump(dict(self.exportJson), file, ensure_ascii=False, indent=4, cls=NumpyJsonEncoder)
+                json.dump(exportJson, file, ensure_ascii=False, indent=4, cls=NumpyJsonEncoder)
 
     def exportFromReferenceFolder(self):
-        sliceStepDataframe = self.pandas.read_csv(self.filepaths["sliceStepFile"], dtype={'patient_id': 'string', 'series_instance_uid': 'string'})
+        sliceStepIndex = loadSliceStepIndex(self.filepaths["sliceStepFile"])
+
+        filenames = self.referenceFilenames()
+
+        if len(self.observerExports) > 0:
+            # the export runs over the image names labeled by any observer
+            for observerExport in [self] + self.observerExports:
+                observerExport.setLabelFilenames(observerExport.referenceFilenames())
+
+            filenames = sorted(set().union(*[observerExport.labelFilenames for observerExport in [self] + self.observerExports]))
+
+        filenames = self.selectPartFilenames(filenames)
+        filenames = self.validateSliceSteps(filenames, sliceStepIndex)
+
+        fsyncInterval = self.settingsHandler.getContentByKeys(["exportFsyncInterval"]) or 10
+        exports = self.allExports()
+
+        for export in exports:
+            export.exportJournal = ExportJournal(export.filepaths["exportFileCSV"], export.filepaths["exportJournal"], fsyncInterval)
+
+        try:
+            filenames = self.resumeFromJournal(filenames)
+            self.processFilenames(filenames, sliceStepIndex)
+        finally:
+            for export in exports:
+                export.exportJournal.close()
+
+        # final export, the csv is the journal csv and the json is streamed from the journal
+        for export in exports:
+            export.exportJournal.writeJson(export.filepaths["exportFileJSON"])
+            export.exportJournal.remove()
+            export.exportJournal = None
+
+        if len(self.observerExports) > 0:
+            self.createObserversTable()
+
+        if self.resultCache is not None:
+            self.resultCache.prune()
+
+    def referenceFilenames(self):
+        # label files of the observer, other files of the folder (e.g. README, .DS_Store) are ignored
+        filenames = []
+
+        for filename in sorted(os.listdir(self.filepaths["referenceFolder"])):
+            if not os.path.isfile(os.path.join(self.filepaths["referenceFolder"], filename)) or self.fileSuffix not in filename:
+                continue
+
+            if not self.isValidFilename(filename):
+                print("Skipping label file without patient id and series instance uid", filename)
+                continue
+
+            filenames.append(filename)
+
+        return filenames
+
+    def isValidFilename(self, filename):
+        # processFilename needs <patientID>_<seriesInstanceUID> in front of the label file suffix
+        return "_" in filename.split(self.fileSuffix)[0]
+
+    def setLabelFilenames(self, filenames):
+        # image name => label filename, shared with the derived export types which read the same label files
+        self.labelFilenames = {}
+
+        for filename in filenames:
+            self.labelFilenames.setdefault(self.processFilename(filename)["filenameWithoutExtension"], filename)
+
+        for derivedExport in self.derivedExports:
+            derivedExport.labelFilenames = self.labelFilenames
+
+    def labelFilename(self, filename):
+        # label file of an export item, the item itself unless the export runs over image names
+        if self.labelFilenames is None:
+            return filename
+
+        return self.labelFilenames.get(filename)
+
+    def allExports(self):
+        # this export, the other observers and the derived export types of each, in journal and merge order
+        exports = []
+
+        for observerExport in [self] + self.observerExports:
+            exports += [observerExport] + observerExport.derivedExports
+
+        return exports
+
+    def createObserversTable(self):
+        # one row per observer, export type, series and score: Observer;ExportType;PatientID;SeriesInstanceUID;Score;Label;Value
+        tables = []
+
+        for export in self.allExports():
+            if not os.path.isfile(export.filepaths["exportFileCSV"]) or os.path.getsize(export.filepaths["exportFileCSV"]) == 0:
+                continue
+
+            table = self.pandas.read_csv(export.filepaths["exportFileCSV"], sep=';', dtype={"PatientID": str, "SeriesInstanceUID": str})
+            table = table.melt(id_vars=["PatientID", "SeriesInstanceUID"], var_name="Score", value_name="Value")
+
+            table[["Score", "Label"]] = table["Score"].str.split("_", n=1, expand=True)
+            table.insert(0, "ExportType", export.exportType)
+            table.insert(0, "Observer", export.observer)
+
+            tables.append(table[["Observer", "ExportType", "PatientID", "SeriesInstanceUID", "Score", "Label", "Value"]])
+
+        if len(tables) > 0:
+            combined = self.pandas.concat(tables, ignore_index=True)
+        else:
+            combined = self.pandas.DataFrame(columns=["Observer", "ExportType", "PatientID", "SeriesInstanceUID", "Score", "Label", "Value"])
+
+        combined.to_csv(self.filepaths["exportFileObserversCSV"], index=False, sep=';', float_format='%.3f')
+
+    def selectPartFilenames(self, filenames):
+        if self.shard is not None:
+            shardIndex, shardCount = self.shard
+            return [filename for filename in filenames if shardOfFilename(filename, shardCount) == shardIndex]
+
+        if self.fileList is not None:
+            selectedFilenames = set(os.path.basename(filename) for filename in self.fileList)
+
+            if self.labelFilenames is not None:
+                # exports over image names accept label filenames of any observer in the file list
+                selectedFilenames = set(self.processFilename(filename)["filenameWithoutExtension"] for filename in selectedFilenames)
+
+            for filename in sorted(selectedFilenames.difference(filenames)):
+                print("File of file list not in reference folder", filename)
+
+            return [filename for filename in filenames if filename in selectedFilenames]
+
+        return filenames
+
+    def findPartialExports(self):
+        # returns {partName: json path} of all partial exports of this dataset, observer and export type
+        partialExports = {}
+
+        for path in glob.glob(glob.escape(self.exportBaseName) + ".part-*.json"):
+            partialExports[path[len(self.exportBaseName) + 1:-len(".json")]] = path
+
+        return partialExports
+
+    def missingShards(self, partNames):
+        # shard parts are named part-<index>-of-<count>, all indices of every count have to exist
+        shardIndices = {}
+
+        for partName in partNames:
+            match = re.fullmatch(r"part-(\d+)-of-(\d+)", partName)
+
+            if match is not None:
+                shardIndices.setdefault(int(match.group(2)), set()).add(int(match.group(1)))
+
+        missing = []
+
+        for shardCount, indices in sorted(shardIndices.items()):
+            missing.extend("part-" + str(index) + "-of-" + str(shardCount) for index in range(shardCount) if index not in indices)
+
+        if len(shardIndices) > 1:
+            print("Partial exports with different shard counts", sorted(shardIndices))
+
+        return missing
+
+    def mergePartialExports(self, partNames=None):
+        # Combines partial exports into the final csv/json, returns False without writing if parts are missing or overlap
+        partialExports = self.findPartialExports()
+
+        if partNames is None:
+            partNames = sorted(partialExports)
+
+        missing = [partName for partName in partNames if partName not in partialExports] + self.missingShards(partNames)
+
+        for partName in missing:
+            print("Missing partial export", partName)
+
+        seriesParts = {}
+        seriesJsons = {}
+
+        for partName in partNames:
+            if partName not in partialExports:
+                continue
+
+            with open(partialExports[partName], 'r', encoding='utf-8') as file:
+                partJson = json.load(file)
+
+            for patientID in partJson:
+                for seriesInstanceUID in partJson[patientID]:
+                    seriesParts.setdefault((patientID, seriesInstanceUID), []).append(partName)
+                    seriesJsons[(patientID, seriesInstanceUID)] = partJson[patientID][seriesInstanceUID]
+
+        duplicates = {series: parts for series, parts in seriesParts.items() if len(parts) > 1}
+
+        for (patientID, seriesInstanceUID), parts in sorted(duplicates.items()):
+            print("Duplicate series", patientID, seriesInstanceUID, "in", ", ".join(parts))
+
+        if len(missing) > 0 or len(duplicates) > 0:
+            return False
+
+        self.reportUnexportedSeries(seriesJsons.keys())
+
+        self.exportJson = {}
+        self.exportList = []
+        self.lesionTables = {}
+
+        # same order as an export that is not sharded, which processes the sorted label filenames
+        for patientID, seriesInstanceUID in sorted(seriesJsons, key=lambda series: series[0] + "_" + series[1]):
+            seriesJson = dict(seriesJsons[(patientID, seriesInstanceUID)])
+            lesionTable = self.lesionTableFromJson(seriesJson.pop("lesions"))
+
+            self.exportJson.setdefault(patientID, {})[seriesInstanceUID] = seriesJson
+            self.lesionTables[(patientID, seriesInstanceUID)] = lesionTable
+            self.exportList.append(self.calculateScore(patientID, seriesInstanceUID, seriesJson, lesionTable))
+
+        self.createExportFilesAndSaveContent(createJson=True)
+        print("Merged", len(seriesJsons), "series from", len(partNames), "partial exports")
+
+        return True
+
+    def reportUnexportedSeries(self, exportedSeries):
+        # series can be skipped on purpose (missing image or slice step), so they are only reported
+        if not self.filepaths["referenceFolder"] or not os.path.isdir(self.filepaths["referenceFolder"]):
+            return
+
+        exportedSeries = set(exportedSeries)
+
+        for filename in self.referenceFilenames():
+            processedFilename = self.processFilename(os.path.join(self.filepaths["referenceFolder"], filename))
+
+            if (processedFilename["patientID"], processedFilename["seriesInstanceUID"]) not in exportedSeries:
+                print("Series not in partial exports", filename)
+
+    def validateSliceSteps(self, filenames, sliceStepIndex):
+        # Reports series without a usable slice step before the export starts and returns the exportable filenames
+        for rowNumber in sliceStepIndex.invalidRows:
+            print("Invalid slice step in", self.filepaths["sliceStepFile"], "row", rowNumber)
+
+        series = {}
+
+        for filename in filenames:
+            processedFilename = self.processFilename(os.path.join(self.filepaths["referenceFolder"], filename))
+            series[filename] = (processedFilename["patientID"], processedFilename["seriesInstanceUID"])
+
+        missing, ambiguous = sliceStepIndex.validate(series.values())
+
+        for patientID, seriesInstanceUID in missing:
+            print("Missing slice step", patientID, seriesInstanceUID)
+
+        for patientID, seriesInstanceUID in ambiguous:
+            print("Duplicate slice step", patientID, seriesInstanceUID)
+
+        skipped = set(missing) | set(ambiguous)
+
+        return [filename for filename in filenames if series[filename] not in skipped]
+
+    def resumeFromJournal(self, filenames):
+        # Keeps the series of an interrupted export whose label file did not change and returns the remaining filenames
+        # with derived export types or observers a series is only kept if it is in the journals of all exports that label it
+        exports = self.allExports()
+        exportRecords = []
+
+        for export in exports:
+            exportRecords.append([record for record in export.exportJournal.readRecords()
+                                  if record["labelFile"] == export.labelFileIdentity(record["filename"])])
+
+        exportedFilenames = [set(record["filename"] for record in records) for records in exportRecords]
+        resumedFilenames = set(filename for filename in filenames
+                               if all(export.labelFilename(filename) is None or export.labelFilename(filename) in exported
+                                      for export, exported in zip(exports, exportedFilenames)))
+
+        if len(resumedFilenames) > 0:
+            print("Resuming export,", len(resumedFilenames), "series restored from", self.filepaths["exportJournal"])
+
+        for export, records in zip(exports, exportRecords):
+            resumedLabelFilenames = set(export.labelFilename(filename) for filename in resumedFilenames)
+            export.exportJournal.open([record for record in records if record["filename"] in resumedLabelFilenames])
+
+        return [filename for filename in filenames if filename not in resumedFilenames]
+
+    def labelFileIdentity(self, filename):
+        filepath = os.path.join(self.filepaths["referenceFolder"], filename)
+
+        if not os.path.isfile(filepath):
+            return None
+
+        stat = os.stat(filepath)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def processFilenames(self, filenames, sliceStepIndex):
+        workerCount = self.exportWorkerCount()
+        readerCount = self.exportReaderCount()
+
+        if workerCount == 1 and readerCount == 0:
+            for filename in filenames:
+                self.mergeSeriesResult(self.processImages(filename, sliceStepIndex))
+        elif workerCount > 1 and self.settingsHandler.getContentByKeys(["exportUseProcesses"]) is True:
+            # only if set explicitly (e.g. by the command line), the export in 3D Slicer uses threads
+            self.processFilenamesInProcesses(filenames, sliceStepIndex, workerCount)
+        else:
+            self.processFilenamesInPipeline(filenames, sliceStepIndex, workerCount, max(1, readerCount))
+
+    def processFilenamesInProcesses(self, filenames, sliceStepIndex, workerCount):
+        # every worker process reads its own series, the series in flight are limited by count and memory budget
+        # results are merged in filename order as soon as they are done
+        memoryBudget = self.exportMemoryBudget()
+        maximumInFlight = self.exportChunkSize(workerCount)
+
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workerCount, initializer=initializeExportWorker,
+                                                          initargs=(self, sliceStepIndex))
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-             [executor.submit(self.processImages, filename, sliceStepDataframe)
-              for filename in sorted(filter(lambda x: os.path.isfile(os.path.join(self.filepaths["referenceFolder"], x)),
-                                            os.listdir(self.filepaths["referenceFolder"])))]
+        with executor:
+            inFlight = collections.deque()
+            inFlightMemory = 0
 
-        # Test code without concurrent!
-        #for filename in sorted(filter(lambda x: os.path.isfile(os.path.join(self.filepaths["referenceFolder"], x)), os.listdir(self.filepaths["referenceFolder"]))):
-        #    self.processImages(filename, sliceStepDataframe)
+            for filename in filenames:
+                seriesMemory = self.estimateSeriesMemory(filename)
+
+                while len(inFlight) > 0 and (len(inFlight) >= maximumInFlight or inFlightMemory + seriesMemory > memoryBudget):
+                    future, memory = inFlight.popleft()
+                    self.mergeSeriesResult(future.result())
+                    inFlightMemory -= memory
+
+                inFlight.append((executor.submit(processImagesInWorker, filename), seriesMemory))
+                inFlightMemory += seriesMemory
+
+            while len(inFlight) > 0:
+                future, memory = inFlight.popleft()
+                self.mergeSeriesResult(future.result())
+
+    def processFilenamesInPipeline(self, filenames, sliceStepIndex, workerCount, readerCount):
+        # readers -> compute threads -> writer (this thread), connected by bounded queues
+        # the volumes of a series are held from reading until its lesion table is computed, limited by the memory budget
+        memoryBudget = MemoryBudget(self.exportMemoryBudget())
+
+        filenameQueue = queue.Queue()
+        computeQueue = queue.Queue(maxsize=workerCount)
+        resultQueue = queue.Queue(maxsize=2 * workerCount)
+
+        for index, filename in enumerate(filenames):
+            filenameQueue.put((index, filename))
+
+        for _ in range(readerCount):
+            filenameQueue.put(None)
+
+        def readStage():
+            while True:
+                item = filenameQueue.get()
+
+                if item is None:
+                    return
+
+                index, filename = item
+                series = None
+
+                try:
+                    series = self.prepareSeries(filename, sliceStepIndex)
+
+                    if series is not None and not series["cached"]:
+                        memoryBudget.acquire(series["memory"])
+                        series["memoryAcquired"] = True
+                        self.readSeries(series)
+                except Exception:
+                    print("Error", filename)
+
+                    if series is not None and series.get("memoryAcquired"):
+                        memoryBudget.release(series["memory"])
+
+                    series = None
+
+                computeQueue.put((index, series))
+
+        def computeStage():
+            while True:
+                item = computeQueue.get()
+
+                if item is None:
+                    return
+
+                index, series = item
+                seriesResult = None
+
+                if series is not None:
+                    try:
+                        seriesResult = self.computeSeries(series)
+                    except Exception:
+                        print("Error", series["patientID"])
+                    finally:
+                        if series.get("memoryAcquired"):
+                            memoryBudget.release(series["memory"])
+
+                        series = None
+
+                resultQueue.put((index, seriesResult))
+
+        threads = [threading.Thread(target=readStage, daemon=True) for _ in range(readerCount)]
+        threads += [threading.Thread(target=computeStage, daemon=True) for _ in range(workerCount)]
+
+        for thread in threads:
+            thread.start()
+
+        # writer: results are merged in filename order, finished series wait for their predecessors
+        waitingResults = {}
+        nextIndex = 0
+
+        while nextIndex < len(filenames):
+            index, seriesResult = resultQueue.get()
+            waitingResults[index] = seriesResult
+
+            while nextIndex in waitingResults:
+                self.mergeSeriesResult(waitingResults.pop(nextIndex))
+                nextIndex += 1
+
+        for _ in range(workerCount):
+            computeQueue.put(None)
+
+        for thread in threads:
+            thread.join()
+
+    def exportWorkerCount(self):
+        # 0 or missing setting => one worker per cpu
+        workerCount = self.settingsHandler.getContentByKeys(["exportWorkers"])
+
+        if not workerCount:
+            workerCount = os.cpu_count() or 1
+
+        return max(1, int(workerCount))
+
+    def exportReaderCount(self):
+        # threads that prefetch volumes for the compute threads, 0 => read and compute one series after another
+        readerCount = self.settingsHandler.getContentByKeys(["exportReaders"])
+
+        if readerCount is None:
+            readerCount = 2
+
+        return max(0, int(readerCount))
+
+    def exportChunkSize(self, workerCount):
+        # maximum number of series submitted to the worker processes at once
+        chunkSize = self.settingsHandler.getContentByKeys(["exportChunkSize"])
+
+        if chunkSize:
+            return max(1, int(chunkSize))
+
+        return 2 * workerCount
+
+    def exportMemoryBudget(self):
+        # 0 or missing setting => half of the available memory
+        budget = self.settingsHandler.getContentByKeys(["exportMemoryBudgetMB"])
+
+        if budget:
+            return int(budget) * 1024 * 1024
+
+        availableMemory = availableMemoryInBytes()
+
+        if availableMemory is None:
+            return float("inf")
+
+        return availableMemory // 2
+
+    def estimateSeriesMemory(self, filename, labelCount=1):
+        # peak memory of one series from the image header, image, label and temporary arrays per voxel
+        # the label files of further observers are held as well until their lesion tables exist
+        processedFilename = self.processFilename(os.path.join(self.filepaths["referenceFolder"], filename))
+        imagePath = os.path.join(self.filepaths["imageFolder"], processedFilename["filenameWithoutExtension"] + ".mhd")
+
+        try:
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(imagePath)
+            reader.ReadImageInformation()
+        except RuntimeError:
+            return 0
+
+        return int(numpy.prod(reader.GetSize())) * (bytesPerVoxelEstimate + 8 * (labelCount - 1))
+
+    def __getstate__(self):
+        # modules and open files cannot be pickled, needed to send the exporter to the worker processes
+        # workers only return per-series results, the collected export state stays in the exporting process
+        state = self.__dict__.copy()
+        del state["pandas"]
+        state["exportJournal"] = None
+        state["exportJson"] = {}
+        state["exportList"] = []
+        state["lesionTables"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pandas = importlib.import_module('pandas')
 
     def processFilename(self, filepath):
         filename = os.path.basename(filepath)
@@ -136,11 +876,44 @@ class CalciumScore():
             "seriesInstanceUID": seriesInstanceUID
         }
 
-    def label(self, referenceTemporaryCopy, uniqueId, structureConnections2d, iterator, connectedElements2d):
-        labeled_array, num_features = ndi.label((referenceTemporaryCopy == uniqueId).astype(int),structure=structureConnections2d)
-        return numpy.where(labeled_array > 0, labeled_array + iterator, 0).astype(connectedElements2d.dtype)
-
     def findLesions(self, reference):
+        # label conversion is compiled once per mode, export type, label definitions and dtype and applied in place with one lookup
+        conversion = ("findLesions", self.segmentationMode, self.exportType, self.settingsHandler.labelIndex.digest)
+        remapSegmentation(reference, conversion, self.remapReferenceValues)
+
+        structure = numpy.array([[[0, 0, 0],
+                                   [0, 1, 0],
+                                   [0, 0, 0]],
+
+                                  [[0, 1, 0],
+                                   [1, 1, 1],
+                                   [0, 1, 0]],
+
+                                  [[0, 0, 0],
+                                   [0, 1, 0],
+                                   [0, 0, 0]]])
+
+        # one labeling pass over all labels >= 2, components touching another label are split afterwards
+        foreground = reference >= 2
+
+        # there are never more components than voxels
+        componentDtype = numpy.uint16 if numpy.count_nonzero(foreground) < numpy.iinfo(numpy.uint16).max else numpy.int32
+        connectedElements, elementCount = ndi.label(foreground, structure=structure, output=componentDtype)
+
+        if elementCount == 0:
+            return connectedElements, 0
+
+        componentIds = numpy.arange(1, elementCount + 1)
+        mixedComponents = componentIds[ndi.minimum(reference, connectedElements, componentIds) !=
+                                       ndi.maximum(reference, connectedElements, componentIds)]
+
+        if len(mixedComponents) > 0:
+            elementCount = self.splitMixedComponents(reference, connectedElements, elementCount, mixedComponents, structure)
+
+        return connectedElements, elementCount
+
+    def remapReferenceValues(self, reference):
+        # definition of the label conversion, only used to compile the lookup table of findLesions
         if self.segmentationMode == "SegmentLevel":
             # preprocessing label
             # Fixes labels that had NFS_CACS as id 24 and 35!
@@ -302,83 +1075,70 @@ class CalciumScore():
 
             reference[(reference >= 5)] = 0
 
-        referenceTemporaryCopy = reference.copy()
-        referenceTemporaryCopy[referenceTemporaryCopy < 2] = 0
+        return reference
 
+    def splitMixedComponents(self, reference, connectedElements, elementCount, mixedComponents, structure):
+        # label boundaries are component boundaries, each mixed component is labeled again per label inside its bounding box
+        boundingBoxes = ndi.find_objects(connectedElements)
 
-        structure = numpy.array([[[0, 0, 0],
-                                   [0, 1, 0],
-                                   [0, 0, 0]],
+        for componentId in mixedComponents:
+            boundingBox = boundingBoxes[componentId - 1]
+            component = connectedElements[boundingBox] == componentId
+            componentReference = reference[boundingBox]
 
-                                  [[0, 1, 0],
-                                   [1, 1, 1],
-                                   [0, 1, 0]],
+            nextIds = [componentId]
 
-                                  [[0, 0, 0],
-                                   [0, 1, 0],
-                                   [0, 0, 0]]])
+            for labelValue in numpy.unique(componentReference[component]):
+                subComponents, subComponentCount = ndi.label(component & (componentReference == labelValue), structure=structure)
 
-        uniqueElements = numpy.unique(referenceTemporaryCopy)
+                # the first part keeps the id of the component, all others are appended
+                while len(nextIds) < subComponentCount:
+                    elementCount += 1
+                    nextIds.append(elementCount)
 
-        connectedElements = numpy.zeros_like(referenceTemporaryCopy)
-        elementIterator = 0
+                ids = numpy.array(nextIds[:subComponentCount], dtype=connectedElements.dtype)
+                subComponentMask = subComponents > 0
+                connectedElements[boundingBox][subComponentMask] = ids[subComponents[subComponentMask] - 1]
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            results = [executor.submit(ndi.label, (referenceTemporaryCopy == uniqueId).astype(int),
-                                       structure=structure)
-                       for uniqueId in uniqueElements[1:]]
+                nextIds = nextIds[subComponentCount:]
 
-            for future in concurrent.futures.as_completed(results):
-                label, elementCount = future.result()
-                connectedElements += numpy.where(label > 0, label + elementIterator, 0).astype(
-                    connectedElements.dtype)
-                elementIterator += elementCount
+        return elementCount
 
-        return connectedElements, len(numpy.unique(connectedElements)) - 1
+    def lesionPositionList(self, connectedElements3d, image, reference):
+        # Returns one [z, y, x, HU, label] table per lesion, built from a single sort of all labeled voxels
+        connectedElements, elementCount = connectedElements3d
+        flatElements = connectedElements.ravel()
 
-    def lesionPositionListEntry(self, connectedElements3d, index, image, reference):
-        positions = numpy.array(list(zip(*numpy.where(connectedElements3d[0] == index))))
+        # stable sort keeps the voxels of each lesion in the same (C) order as numpy.where
+        voxelIndices = numpy.flatnonzero(flatElements)
+        voxelIndices = voxelIndices[numpy.argsort(flatElements[voxelIndices], kind="stable")]
 
-        newList = []
+        voxelCounts = numpy.bincount(flatElements[voxelIndices], minlength=elementCount + 1)[1:]
 
-        for element in positions:
-            attenuation = image[element[0], element[1], element[2]]
-            originalLabel = reference[element[0], element[1], element[2]]
-            element = numpy.concatenate((element, [attenuation, originalLabel]))
-            newList.append(element)
+        positions = numpy.unravel_index(voxelIndices, connectedElements.shape)
+        lesionTable = numpy.column_stack(positions + (image.ravel()[voxelIndices], reference.ravel()[voxelIndices]))
 
-        return numpy.array(newList)
+        lesions = numpy.split(lesionTable, numpy.cumsum(voxelCounts)[:-1])
 
-    def jsonLesionLoop(self, lesion, it, patientID,seriesInstanceUID):
-        self.exportJson[patientID][seriesInstanceUID]["lesions"][it] = {}
-        self.exportJson[patientID][seriesInstanceUID]["lesions"][it]["voxelCount3d"] = len(lesion)
-        self.exportJson[patientID][seriesInstanceUID]["lesions"][it]["slices"] = {}
+        return [lesion for lesion in lesions if len(lesion) > 0]
 
-        slices = lesion[:, 0:1]
-        slice, voxelCount = numpy.unique(slices, return_counts=True)
-        slicesDict = dict(zip(slice, voxelCount))
+    def lesionTableLoop(self, lesion, it):
+        rows = []
 
-        sliceIterator = 0
-        for slice in slicesDict:
-            self.jsonSliceLoop(patientID, seriesInstanceUID, it, lesion, slice, sliceIterator, slicesDict)
-            sliceIterator += 1
+        slices = lesion[:, 0]
+        for slice in numpy.unique(slices):
+            rows.extend(self.sliceTableLoop(lesion[slices == slice], it, slice))
 
-    def jsonSliceLoop(self, patientID, seriesInstanceUID, it, lesion, slice, sliceIterator, slicesDict):
-        sliceArray = lesion[numpy.in1d(lesion[:, 0], slice)]
+        return rows
 
+    def sliceTableLoop(self, sliceArray, it, slice):
         #needed to check if lesions are seperated in 2d but connected in 3d
-        maxCoordinate = 513
+        #only the bounding box of the lesion in this slice is analysed, so any matrix size is supported
+        rows = (sliceArray[:, 1] - sliceArray[:, 1].min()).astype(numpy.intp)
+        columns = (sliceArray[:, 2] - sliceArray[:, 2].min()).astype(numpy.intp)
 
-        tempComponentAnalysis = numpy.zeros(shape=(maxCoordinate,maxCoordinate))
-        tempAttenuation = numpy.zeros(shape=(maxCoordinate, maxCoordinate))
-        tempLabel = numpy.zeros(shape=(maxCoordinate, maxCoordinate))
-
-        for element in sliceArray:
-            row = element[1]
-            column = element[2]
-            tempComponentAnalysis[row, column] = 1
-            tempAttenuation[row, column] = element[3]
-            tempLabel[row, column] = element[4]
+        tempComponentAnalysis = numpy.zeros(shape=(rows.max() + 1, columns.max() + 1), dtype=numpy.uint8)
+        tempComponentAnalysis[rows, columns] = 1
 
         structureConnections2d = numpy.array([[0, 1, 0],
                                                [1, 1, 1],
@@ -386,76 +1146,120 @@ class CalciumScore():
 
         connections, N = label(tempComponentAnalysis, structureConnections2d)
 
-        self.exportJson[patientID][seriesInstanceUID]["lesions"][it]["slices"][sliceIterator] = {}
-        self.exportJson[patientID][seriesInstanceUID]["lesions"][it]["slices"][sliceIterator]["voxelCount2D"] = slicesDict[slice]
-        self.exportJson[patientID][seriesInstanceUID]["lesions"][it]["slices"][sliceIterator]["labeledAs"] = {}
-        self.exportJson[patientID][seriesInstanceUID]["lesions"][it]["slices"][sliceIterator]["sliceNumber"] = slice
-
         if N > 1:
-            labelsSummary = {}
+            # one group per (2d component, label) pair, sliceArray rows are already in raster order
+            components = connections[rows, columns]
+            groups, firstIndex, groupIds, voxelCounts = numpy.unique(numpy.column_stack((components, sliceArray[:, 4])), axis=0,
+                                                                     return_index=True, return_inverse=True, return_counts=True)
 
-            for lesionId in range(1, N + 1):
-                positions = numpy.array(list(zip(*numpy.where(connections == lesionId))))
-                lesionSummary = {}
+            maxAttenuations = ndi.maximum(sliceArray[:, 3].astype(float), labels=groupIds.ravel(), index=numpy.arange(len(groups)))
 
-                for position in positions:
-                    labelAtPosition = tempLabel[position[0],position[1]]
-                    attenuationAtPosition = tempAttenuation[position[0],position[1]]
+            # keeps the order in which the labels appear inside each component
+            return [(it, slice, groups[group][0], groups[group][1], voxelCounts[group], maxAttenuations[group])
+                    for group in numpy.lexsort((firstIndex, groups[:, 0]))]
+        else:
+            # component 0 marks slices that are not split in 2d, the whole slice shares one max attenuation
+            maxAttenuation = sliceArray[:, 3].max()
+            arteries, arteryCount = numpy.unique(sliceArray[:, 4], return_counts=True)
 
-                    if self.arteryId[labelAtPosition] in lesionSummary:
-                        lesionSummary[self.arteryId[labelAtPosition]]["voxelCount"] = lesionSummary[self.arteryId[labelAtPosition]]["voxelCount"] + 1
-                        if attenuationAtPosition > lesionSummary[self.arteryId[labelAtPosition]]["maxAttenuation"]:
-                            lesionSummary[self.arteryId[labelAtPosition]]["maxAttenuation"] = attenuationAtPosition
-                    else:
-                        lesionSummary[self.arteryId[labelAtPosition]] = {}
-                        lesionSummary[self.arteryId[labelAtPosition]]["voxelCount"] = 1
-                        lesionSummary[self.arteryId[labelAtPosition]]["maxAttenuation"] = attenuationAtPosition
+            return [(it, slice, 0, artery, voxelCount, maxAttenuation) for artery, voxelCount in zip(arteries, arteryCount)]
 
-                labelsSummary[lesionId] = lesionSummary
+    def calculateLesions(self, image, reference, connectedElements3d):
+        lesionPositionList = self.lesionPositionList(connectedElements3d, image, reference)
 
-            self.exportJson[patientID][seriesInstanceUID]["lesions"][it]["slices"][sliceIterator]["labeledAs"] = labelsSummary
-            self.exportJson[patientID][seriesInstanceUID]["lesions"][it]["slices"][sliceIterator]["maxAttenuation"] = None
-        else:
-            self.exportJson[patientID][seriesInstanceUID]["lesions"][it]["slices"][sliceIterator]["maxAttenuation"] = max(max(sliceArray[:, 3:4]))
+        rows = []
+
+        it = 0
+        for lesion in lesionPositionList:
+            rows.extend(self.lesionTableLoop(lesion, it))
 
-            arteryId = sliceArray[:, 4:5]
-            arteries, arteryCount = numpy.unique(arteryId, return_counts=True)
-            arteryDict = dict(zip(arteries, arteryCount))
+            it += 1
 
-            for artery in arteryDict:
-                self.exportJson[patientID][seriesInstanceUID]["lesions"][it]["slices"][sliceIterator]["labeledAs"][self.arteryId[artery]] = arteryDict[artery]
+        return numpy.array(rows, dtype=lesionTableDtype)
 
-    def calculateLesions(self, image, reference, connectedElements3d, patientID, seriesInstanceUID):
-        lesionPositionList = []
+    def lesionTableToJson(self, lesionTable):
+        # nested lesion json as exported to file, only created when writing the export
+        lesionsJson = {}
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            results = [executor.submit(self.lesionPositionListEntry, connectedElements3d, index, image, reference) for index in range(1, connectedElements3d[1] + 1)]
+        for row in lesionTable:
+            lesionsJson.setdefault(int(row["lesion"]), {"voxelCount3d": 0, "slices": {}})
+            lesionJson = lesionsJson[int(row["lesion"])]
 
-            for future in concurrent.futures.as_completed(results):
-                lesionPositionList.append(future.result())
+            slicesJson = lesionJson["slices"]
+            if len(slicesJson) == 0 or slicesJson[len(slicesJson) - 1]["sliceNumber"] != row["slice"]:
+                slicesJson[len(slicesJson)] = {"voxelCount2D": 0, "labeledAs": {}, "sliceNumber": int(row["slice"]), "maxAttenuation": None}
 
-        it = 0
-        for lesion in lesionPositionList:
-            self.jsonLesionLoop(lesion, it, patientID, seriesInstanceUID)
+            sliceJson = slicesJson[len(slicesJson) - 1]
+            sliceJson["voxelCount2D"] += int(row["voxelCount"])
+            lesionJson["voxelCount3d"] += int(row["voxelCount"])
 
-            it += 1
+            if row["component"] == 0:
+                # written as an integer HU value like the maximum of the integer image, split slices keep the float maximum
+                sliceJson["maxAttenuation"] = self.attenuationToJson(row["maxAttenuation"])
+                sliceJson["labeledAs"][self.arteryId[row["label"]]] = int(row["voxelCount"])
+            else:
+                sliceJson["labeledAs"].setdefault(int(row["component"]), {})
+                sliceJson["labeledAs"][int(row["component"])][self.arteryId[row["label"]]] = {
+                    "voxelCount": int(row["voxelCount"]),
+                    "maxAttenuation": float(row["maxAttenuation"])
+                }
+
+        return lesionsJson
+
+    def attenuationToJson(self, attenuation):
+        attenuation = float(attenuation)
+
+        return int(attenuation) if attenuation.is_integer() else attenuation
+
+    def lesionTableFromJson(self, lesionsJson):
+        rows = []
+
+        for lesionJson in lesionsJson:
+            for sliceJson in lesionsJson[lesionJson]["slices"].values():
+                if sliceJson["maxAttenuation"] is not None:
+                    for artery in sliceJson["labeledAs"]:
+                        rows.append((int(lesionJson), sliceJson["sliceNumber"], 0, self.Items[artery], sliceJson["labeledAs"][artery], sliceJson["maxAttenuation"]))
+                else:
+                    for subLabelId in sliceJson["labeledAs"]:
+                        for artery in sliceJson["labeledAs"][subLabelId]:
+                            rows.append((int(lesionJson), sliceJson["sliceNumber"], int(subLabelId), self.Items[artery],
+                                         sliceJson["labeledAs"][subLabelId][artery]["voxelCount"], sliceJson["labeledAs"][subLabelId][artery]["maxAttenuation"]))
+
+        return numpy.array(rows, dtype=lesionTableDtype)
 
-    def agatstonScore(self, voxelLength, voxelCount, attenuation, ratio):
-        score = 0.0
+    def seriesJson(self, patientID, seriesInstanceUID):
+        return self.seriesJsonWithLesions(self.exportJson[patientID][seriesInstanceUID],
+                                          self.lesionTables.get((patientID, seriesInstanceUID), numpy.zeros(0, dtype=lesionTableDtype)))
 
-        if (voxelLength is not None) and (voxelCount is not None) and (attenuation is not None) and (ratio is not None):
+    def seriesJsonWithLesions(self, seriesJson, lesionTable):
+        seriesJson = dict(seriesJson)
+        seriesJson["lesions"] = self.lesionTableToJson(lesionTable)
+
+        return seriesJson
+
+    def agatstonScore(self, voxelLength, voxelCount, attenuation, ratio, threshold=130, densityBands=agatstonDensityBands):
+        # vectorized over all rows of a lesion table
+        score = numpy.zeros(len(voxelCount))
+
+        if (voxelLength is not None) and (ratio is not None):
             voxelArea = voxelLength * voxelLength
             lesionArea = voxelArea * voxelCount
 
-            if attenuation >= 130 and lesionArea > 1:
-                score = lesionArea * self.densityFactor(attenuation) * ratio
+            scored = (attenuation >= threshold) & (lesionArea > 1)
+            score[scored] = lesionArea[scored] * self.densityFactor(attenuation[scored], densityBands) * ratio
 
         return score
 
+    def agatstonSweepScore(self, seriesJson, lesionTable, configuration):
+        # same definition as Agatston_ (all voxels of a lesion row), only the threshold and the density bands of the max attenuation change
+        return self.agatstonScore(seriesJson["voxelLength"], lesionTable["voxelCount"], lesionTable["maxAttenuation"], seriesJson["sliceRatio"],
+                                  configuration["threshold"], configuration["densityBands"])
+
     def volumeScore(self, voxelLength, voxelCount, sliceThickness, ratio):
-        score = 0.0
+        # vectorized over all rows of a lesion table
+        score = numpy.zeros(len(voxelCount))
 
-        if (voxelLength is not None) and (voxelCount is not None) and (sliceThickness is not None) and (ratio is not None):
+        if (voxelLength is not None) and (sliceThickness is not None) and (ratio is not None):
             voxelArea = voxelLength * voxelLength
             lesionArea = voxelArea * voxelCount
 
@@ -474,9 +1278,9 @@ class CalciumScore():
 
         return newObject
 
-    def calculateScore(self, patientID, seriesInstanceUID):
-        agatstonScore = self.addPrefixToKey(self.calculateVariationsOfCalciumScore(patientID, seriesInstanceUID, "Agatston"), "Agatston_")
-        volumeScore = self.addPrefixToKey(self.calculateVariationsOfCalciumScore(patientID, seriesInstanceUID, "Volume"), "Volume_")
+    def calculateScore(self, patientID, seriesInstanceUID, seriesJson, lesionTable):
+        agatstonScore = self.addPrefixToKey(self.calculateVariationsOfCalciumScore(patientID, seriesInstanceUID, seriesJson, lesionTable, "Agatston"), "Agatston_")
+        volumeScore = self.addPrefixToKey(self.calculateVariationsOfCalciumScore(patientID, seriesInstanceUID, seriesJson, lesionTable, "Volume"), "Volume_")
 
         combined = agatstonScore
 
@@ -484,54 +1288,41 @@ class CalciumScore():
             if key != "PatientID" and key != "SeriesInstanceUID":
                 combined[key] = volumeScore[key]
 
+        # one column set per sweep configuration, e.g. Agatston100HU_CC
+        for configuration in self.agatstonSweep:
+            sweepScore = self.addPrefixToKey(self.calculateVariationsOfCalciumScore(patientID, seriesInstanceUID, seriesJson, lesionTable, "AgatstonSweep", configuration),
+                                             "Agatston" + configuration["name"] + "_")
+
+            for key in sweepScore:
+                if key != "PatientID" and key != "SeriesInstanceUID":
+                    combined[key] = sweepScore[key]
+
         return combined
 
-    def calculateVariationsOfCalciumScore(self, patientID, seriesInstanceUID, typeOfScore):
+    def calculateVariationsOfCalciumScore(self, patientID, seriesInstanceUID, seriesJson, lesionTable, typeOfScore, sweepConfiguration=None):
         total = {"PatientID": patientID, "SeriesInstanceUID": seriesInstanceUID}
 
         for key in self.Items:
             total[key] = 0.0
 
-        for lesionsJson in self.exportJson[patientID][seriesInstanceUID]["lesions"]:
-            for sliceJson in self.exportJson[patientID][seriesInstanceUID]["lesions"][lesionsJson]["slices"]:
-
-                sliceNumber = self.exportJson[patientID][seriesInstanceUID]["lesions"][lesionsJson]["slices"][sliceJson]["sliceNumber"]
-                if sliceNumber in self.exportJson[patientID][seriesInstanceUID]["countingSlices"]:
-                    attenuation = self.exportJson[patientID][seriesInstanceUID]["lesions"][lesionsJson]["slices"][sliceJson]["maxAttenuation"]
-
-                    if attenuation is not None:
-                        for arteryJson in self.exportJson[patientID][seriesInstanceUID]["lesions"][lesionsJson]["slices"][sliceJson]["labeledAs"]:
-                            voxelCount = self.exportJson[patientID][seriesInstanceUID]["lesions"][lesionsJson]["slices"][sliceJson]["labeledAs"][arteryJson]
-                            voxelLength = self.exportJson[patientID][seriesInstanceUID]["voxelLength"]
-
-                            if typeOfScore == "Agatston":
-                                score = self.agatstonScore(voxelLength, voxelCount, attenuation, self.exportJson[patientID][seriesInstanceUID]["sliceRatio"])
-                            if typeOfScore == "Volume":
-                                score = self.volumeScore(voxelLength, voxelCount, self.exportJson[patientID][seriesInstanceUID]["sliceThickness"], self.exportJson[patientID][seriesInstanceUID]["sliceRatio"])
-
-                            if arteryJson in total:
-                                total[arteryJson] += score
-                            else:
-                                total[arteryJson] = score
-                    else:
-                        for subLabelId in self.exportJson[patientID][seriesInstanceUID]["lesions"][lesionsJson]["slices"][sliceJson]["labeledAs"]:
-                            for sublabelArtery in self.exportJson[patientID][seriesInstanceUID]["lesions"][lesionsJson]["slices"][sliceJson]["labeledAs"][subLabelId]:
-                                maxAttenuation = self.exportJson[patientID][seriesInstanceUID]["lesions"][lesionsJson]["slices"][sliceJson]["labeledAs"][subLabelId][sublabelArtery]["maxAttenuation"]
-                                voxelLength = self.exportJson[patientID][seriesInstanceUID]["voxelLength"]
-                                voxelCount = self.exportJson[patientID][seriesInstanceUID]["lesions"][lesionsJson]["slices"][sliceJson]["labeledAs"][subLabelId][sublabelArtery]["voxelCount"]
-
-                                if typeOfScore == "Agatston":
-                                    score = self.agatstonScore(voxelLength, voxelCount, maxAttenuation, self.exportJson[patientID][seriesInstanceUID]["sliceRatio"])
-                                if typeOfScore == "Volume":
-                                    score = self.volumeScore(voxelLength, voxelCount, self.exportJson[patientID][seriesInstanceUID]["sliceThickness"], self.exportJson[patientID][seriesInstanceUID]["sliceRatio"])
-
-                                if sublabelArtery in total:
-                                    total[sublabelArtery] += score
-                                else:
-                                    total[sublabelArtery] = score
+        lesionTable = lesionTable[numpy.isin(lesionTable["slice"], seriesJson["countingSlices"])]
+
+        if typeOfScore == "Agatston":
+            scores = self.agatstonScore(seriesJson["voxelLength"], lesionTable["voxelCount"], lesionTable["maxAttenuation"], seriesJson["sliceRatio"])
+        if typeOfScore == "AgatstonSweep":
+            scores = self.agatstonSweepScore(seriesJson, lesionTable, sweepConfiguration)
+        if typeOfScore == "Volume":
+            scores = self.volumeScore(seriesJson["voxelLength"], lesionTable["voxelCount"], seriesJson["sliceThickness"], seriesJson["sliceRatio"])
+
+        # group by label, bincount sums the scores in table order
+        labels, labelIndex = numpy.unique(lesionTable["label"], return_inverse=True)
+        labelScores = numpy.bincount(labelIndex, weights=scores, minlength=len(labels))
+
+        for labelValue, score in zip(labels, labelScores):
+            total[self.arteryId[labelValue]] += score
 
         for key in self.Items:
-            if isinstance(self.Items[key], list):
+            if isinstance(self.Items[key], numpy.ndarray):
                 sum = 0.0
                 for id in self.Items[key]:
                     if id in self.arteryId and self.arteryId[id] in total:
@@ -541,64 +1332,229 @@ class CalciumScore():
 
         return total
 
-    def calculateScoreFromImage(self, image, reference, patientID, seriesInstanceUID):
-        connectedElements = self.findLesions(reference)
+    def processImages(self, filename, sliceStepIndex):
+        # Runs in the export workers, the result only depends on the given file and is merged by mergeSeriesResult
+        series = self.prepareSeries(filename, sliceStepIndex)
 
-        self.calculateLesions(image, reference, connectedElements, patientID, seriesInstanceUID)
-        return self.calculateScore(patientID, seriesInstanceUID)
+        if series is None:
+            return None
 
-    def processImages(self, filename, sliceStepDataframe):
+        try:
+            if not series["cached"]:
+                self.readSeries(series)
+
+            return self.computeSeries(series)
+        except Exception:
+            print("Error", series["patientID"])
+
+        return None
+
+    def prepareSeries(self, filename, sliceStepIndex):
+        # paths, slice step and cached lesion tables of one series, None if the image or the slice step is missing
         processedFilename = self.processFilename(os.path.join(self.filepaths["referenceFolder"], filename))
 
-        if os.path.isfile(os.path.join(self.filepaths["imageFolder"], processedFilename["filenameWithoutExtension"] + ".mhd")):
-            image = sitk.ReadImage(os.path.join(self.filepaths["imageFolder"], processedFilename["filenameWithoutExtension"] + ".mhd"))
-            label = sitk.ReadImage(os.path.join(self.filepaths["referenceFolder"], filename))
+        imagePath = os.path.join(self.filepaths["imageFolder"], processedFilename["filenameWithoutExtension"] + ".mhd")
+
+        if not os.path.isfile(imagePath):
+            return None
+
+        sliceStepEntry = sliceStepIndex.lookup(processedFilename["patientID"], processedFilename["seriesInstanceUID"])
+
+        if sliceStepEntry is None:
+            print("Missing slice step", processedFilename["patientID"])
+            return None
+
+        sliceThickness, sliceStep = sliceStepEntry
+
+        series = {
+            "filename": filename,
+            "patientID": processedFilename["patientID"],
+            "seriesInstanceUID": processedFilename["seriesInstanceUID"],
+            "imagePath": imagePath,
+            "sliceThickness": sliceThickness,
+            "sliceStep": sliceStep
+        }
+
+        # label file of this and every other observer, None if the observer did not label the image
+        series["labels"] = [observerExport.prepareLabel(series) for observerExport in [self] + self.observerExports]
+        series["cached"] = all(label is None or label["cached"] for label in series["labels"])
+
+        if not series["cached"]:
+            series["memory"] = self.estimateSeriesMemory(filename, sum(label is not None for label in series["labels"]))
+
+        return series
+
+    def prepareLabel(self, series):
+        labelFilename = self.labelFilename(series["filename"])
+
+        if labelFilename is None:
+            return None
+
+        label = {
+            "filename": labelFilename,
+            "labelPath": os.path.join(self.filepaths["referenceFolder"], labelFilename)
+        }
+
+        # (cacheKey, cached seriesJson and lesion table) of this and every derived export type
+        label["cachedSeries"] = [export.loadCachedSeries(series["imagePath"], label["labelPath"], series) for export in [self] + self.derivedExports]
+        label["cached"] = all(cachedSeries is not None for cacheKey, cachedSeries in label["cachedSeries"])
+
+        return label
+
+    def loadCachedSeries(self, imagePath, labelPath, series):
+        if self.resultCache is None:
+            return None, None
+
+        # changed label values or export groups invalidate the cached lesion tables
+        parameters = [self.segmentationMode, self.exportType, series["sliceThickness"], series["sliceStep"], self.settingsHandler.labelIndex.digest]
+
+        cacheKey = self.resultCache.createKey([imagePath, labelPath], parameters)
+
+        return cacheKey, self.resultCache.load(cacheKey)
+
+    def readSeries(self, series):
+        # volumes decoded during the labeling session are reused, the export itself does not fill the session cache
+        volumeCache = currentVolumeCache()
+
+        if volumeCache is not None:
+            series["imageArray"], geometry = volumeCache.read(series["imagePath"], store=False)
+            spacing = geometry["spacing"]
+        else:
+            image = sitk.ReadImage(series["imagePath"])
 
             # Convert the image to a numpy array first and then shuffle the dimensions to get axis in the order z,y,x
-            imageArray = sitk.GetArrayFromImage(image)
-            labelArray = sitk.GetArrayFromImage(label)
-
-            # Read the spacing along each dimension
-            spacing = numpy.array(list(reversed(image.GetSpacing())))
-            sliceThickness = sliceStepDataframe.loc[(sliceStepDataframe['series_instance_uid'] == processedFilename["seriesInstanceUID"])].slice_thickness.item()
-            sliceStep = sliceStepDataframe.loc[(sliceStepDataframe['series_instance_uid'] == processedFilename["seriesInstanceUID"])].slice_step.item()
-
-            if processedFilename["patientID"] not in self.exportJson:
-                self.exportJson[processedFilename["patientID"]] = {}
-
-            self.exportJson[processedFilename["patientID"]][processedFilename["seriesInstanceUID"]] = {}
-            self.exportJson[processedFilename["patientID"]][processedFilename["seriesInstanceUID"]]["sliceRatio"] = sliceThickness / 3.0
-            self.exportJson[processedFilename["patientID"]][processedFilename["seriesInstanceUID"]]["sliceThickness"] = sliceThickness
-            self.exportJson[processedFilename["patientID"]][processedFilename["seriesInstanceUID"]]["voxelLength"] = spacing[1]  # voxel length in mm
-            self.exportJson[processedFilename["patientID"]][processedFilename["seriesInstanceUID"]]["lesions"] = {}
-            self.exportJson[processedFilename["patientID"]][processedFilename["seriesInstanceUID"]]["sliceCount"] = len(imageArray)
-            self.exportJson[processedFilename["patientID"]][processedFilename["seriesInstanceUID"]]["sliceStep"] = sliceStep
-
-            countingSlices = []
-
-            # using float numbers instead of int!
-            for sliceNumber in numpy.arange(0, len(imageArray), sliceStep):
-                countingSlices.append(sliceNumber)
-
-            #for sliceNumber in range(0, len(imageArray), sliceStep):
-            #    countingSlices.append(sliceNumber)
-
-            try:
-                self.exportJson[processedFilename["patientID"]][processedFilename["seriesInstanceUID"]]["countingSlices"] = countingSlices
-                result = self.calculateScoreFromImage(imageArray, labelArray, processedFilename["patientID"], processedFilename["seriesInstanceUID"])
-
-                self.exportList.append(result)
-                self.createExportFilesAndSaveContent(createJson=True)
-                print("Exported " + processedFilename["patientID"])
-            except:
-                print("Error", processedFilename["patientID"])
-
-    def densityFactor(self, maxDensity):
-        if maxDensity >= 130 and maxDensity <= 199:
-            return 1
-        if maxDensity >= 200 and maxDensity <= 299:
-            return 2
-        if maxDensity >= 300 and maxDensity <= 399:
-            return 3
-        if maxDensity >= 400:
-            return 4
\ No newline at end of file
+            series["imageArray"] = sitk.GetArrayFromImage(image)
+            spacing = image.GetSpacing()
+
+        # Read the spacing along each dimension
+        series["spacing"] = numpy.array(list(reversed(spacing)))
+
+        # the image is read once for all observers
+        for label in series["labels"]:
+            if label is not None and not label["cached"]:
+                if volumeCache is not None:
+                    label["labelArray"] = volumeCache.readArray(label["labelPath"], store=False)
+                else:
+                    label["labelArray"] = sitk.GetArrayFromImage(sitk.ReadImage(label["labelPath"]))
+
+    def computeSeries(self, series):
+        # the volumes are removed from series, so they are released as soon as the lesion tables exist
+        imageArray = series.pop("imageArray", None)
+        spacing = series.pop("spacing", None)
+
+        seriesResults = []
+
+        for observerExport, label in zip([self] + self.observerExports, series.pop("labels")):
+            if label is None:
+                seriesResults.append(None)
+            else:
+                seriesResults.append(observerExport.computeLabelResult(series, label, imageArray, spacing))
+
+        if len(self.observerExports) == 0:
+            return seriesResults[0]
+
+        return {"observerResults": seriesResults}
+
+    def computeLabelResult(self, series, label, imageArray, spacing):
+        # all export types share the volumes and the calcium region, only the label conversion and labeling run per type
+        volumes = None
+
+        if not label["cached"]:
+            labelArray = label.pop("labelArray")
+            volumes = (imageArray, labelArray, spacing, calciumRegion(labelArray))
+
+        labelSeries = dict(series, filename=label["filename"])
+
+        exports = [self] + self.derivedExports
+        seriesResults = [export.computeSeriesResult(labelSeries, cacheKey, cachedSeries, volumes)
+                         for export, (cacheKey, cachedSeries) in zip(exports, label.pop("cachedSeries"))]
+
+        seriesResult = seriesResults[0]
+        seriesResult["derivedResults"] = seriesResults[1:]
+
+        return seriesResult
+
+    def computeSeriesResult(self, series, cacheKey, cachedSeries, volumes):
+        if cachedSeries is not None:
+            seriesJson, lesionTable = cachedSeries
+        else:
+            seriesJson, lesionTable = self.calculateLesionTable(*volumes, series["sliceThickness"], series["sliceStep"])
+
+            if self.resultCache is not None:
+                self.resultCache.save(cacheKey, seriesJson, lesionTable, NumpyJsonEncoder)
+
+        result = self.calculateScore(series["patientID"], series["seriesInstanceUID"], seriesJson, lesionTable)
+
+        return {
+            "filename": series["filename"],
+            "patientID": series["patientID"],
+            "seriesInstanceUID": series["seriesInstanceUID"],
+            "seriesJson": seriesJson,
+            "lesionTable": lesionTable,
+            "result": result,
+            "derivedResults": []
+        }
+
+    def calculateLesionTable(self, imageArray, labelArray, spacing, region, sliceThickness, sliceStep):
+        seriesJson = {}
+        seriesJson["sliceRatio"] = sliceThickness / 3.0
+        seriesJson["sliceThickness"] = sliceThickness
+        seriesJson["voxelLength"] = spacing[1]  # voxel length in mm
+        seriesJson["sliceCount"] = len(imageArray)
+        seriesJson["sliceStep"] = sliceStep
+
+        countingSlices = []
+
+        # using float numbers instead of int!
+        for sliceNumber in numpy.arange(0, len(imageArray), sliceStep):
+            countingSlices.append(sliceNumber)
+
+        #for sliceNumber in range(0, len(imageArray), sliceStep):
+        #    countingSlices.append(sliceNumber)
+
+        seriesJson["countingSlices"] = countingSlices
+
+        if region is None:
+            return seriesJson, numpy.zeros(0, dtype=lesionTableDtype)
+
+        # lesions are only searched inside the calcium region, findLesions converts its copy of the labels in place
+        reference = labelArray[region].copy()
+
+        connectedElements = self.findLesions(reference)
+        lesionTable = self.calculateLesions(imageArray[region], reference, connectedElements)
+        lesionTable["slice"] += region[0].start
+
+        return seriesJson, lesionTable
+
+    def mergeSeriesResult(self, seriesResult):
+        # Only called by the exporting process, in filename order
+        # the series is only written to the journal, the final csv and json are created from it
+        if seriesResult is None:
+            return
+
+        if "observerResults" in seriesResult:
+            for observerExport, observerResult in zip([self] + self.observerExports, seriesResult["observerResults"]):
+                observerExport.mergeSeriesResult(observerResult)
+
+            return
+
+        patientID = seriesResult["patientID"]
+
+        self.exportJournal.append({
+            "filename": seriesResult["filename"],
+            "labelFile": self.labelFileIdentity(seriesResult["filename"]),
+            "patientID": patientID,
+            "seriesInstanceUID": seriesResult["seriesInstanceUID"],
+            "series": self.seriesJsonWithLesions(seriesResult["seriesJson"], seriesResult["lesionTable"]),
+            "result": seriesResult["result"]
+        })
+
+        for derivedExport, derivedResult in zip(self.derivedExports, seriesResult["derivedResults"]):
+            derivedExport.mergeSeriesResult(derivedResult)
+
+        print("Exported " + patientID)
+
+    def densityFactor(self, maxDensity, densityBands=agatstonDensityBands):
+        # default bands: 130-199 => 1, 200-299 => 2, 300-399 => 3, 400+ => 4
+        weights = numpy.array([0] + [weight for bound, weight in densityBands])
+        return weights[numpy.digitize(maxDensity, [bound for bound, weight in densityBands])]
\ No newline at end of file
@@ -0,0 +1,109 @@
+# this class reads the next cases of the labeler on a background thread while the current case is labeled
+# only files are read here, the slicer nodes are created from the prefetched data on the main thread
+
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import SimpleITK as sitk
+
+class CasePrefetcher():
+    def __init__(self, maxCases, thresholdValue, volumeCache=None):
+        self.maxCases = maxCases
+        self.thresholdValue = thresholdValue
+        # the read volumes are also kept in the session volume cache if one is given
+        self.volumeCache = volumeCache
+
+        # imagePath => (labelPath, future), at most maxCases, oldest request first
+        self.cases = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="CasePrefetcher")
+
+    def modificationTime(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def readImage(self, imagePath):
+        if self.volumeCache is not None:
+            return self.volumeCache.readImage(imagePath)
+
+        return sitk.ReadImage(imagePath)
+
+    def readLabelArray(self, labelPath):
+        if self.volumeCache is not None:
+            return self.volumeCache.readArray(labelPath)
+
+        return sitk.GetArrayFromImage(sitk.ReadImage(labelPath))
+
+    def readCase(self, imagePath, labelPath):
+        image = self.readImage(imagePath)
+
+        case = {
+            "imagePath": imagePath,
+            "image": image,
+            "thresholdMask": sitk.GetArrayViewFromImage(image) >= self.thresholdValue,
+            "labelPath": labelPath,
+            "labelArray": None,
+            "modificationTimes": {imagePath: self.modificationTime(imagePath)}
+        }
+
+        # label of the other segmentation mode that is converted by runThreshold
+        if labelPath is not None and os.path.isfile(labelPath):
+            case["modificationTimes"][labelPath] = self.modificationTime(labelPath)
+            case["labelArray"] = self.readLabelArray(labelPath)
+
+        return case
+
+    def prefetch(self, requests):
+        # requests: [(imagePath, labelPath or None)] of the next cases, cases that are no longer requested are dropped
+        requests = requests[:self.maxCases]
+        requestedPaths = set(imagePath for imagePath, _ in requests)
+
+        for imagePath in list(self.cases):
+            if imagePath not in requestedPaths:
+                _, future = self.cases.pop(imagePath)
+                future.cancel()
+
+        for imagePath, labelPath in requests:
+            if imagePath in self.cases and self.cases[imagePath][0] == labelPath:
+                continue
+
+            self.cases[imagePath] = (labelPath, self.executor.submit(self.readCase, imagePath, labelPath))
+
+    def take(self, imagePath, labelPath=None):
+        # returns the prefetched case or None, waits if the case is still being read
+        if imagePath not in self.cases:
+            return None
+
+        requestedLabelPath, future = self.cases.pop(imagePath)
+
+        if requestedLabelPath != labelPath:
+            future.cancel()
+            return None
+
+        try:
+            case = future.result()
+        except Exception as error:
+            print("Prefetching " + imagePath + " failed:", error)
+            return None
+
+        # files changed after they were read
+        for path, modificationTime in case["modificationTimes"].items():
+            if self.modificationTime(path) != modificationTime:
+                return None
+
+        if labelPath is not None and case["labelArray"] is None and os.path.isfile(labelPath):
+            return None
+
+        return case
+
+    def clear(self):
+        for _, future in self.cases.values():
+            future.cancel()
+
+        self.cases = OrderedDict()
+
+    def shutdown(self):
+        self.clear()
+        self.executor.shutdown(wait=False)
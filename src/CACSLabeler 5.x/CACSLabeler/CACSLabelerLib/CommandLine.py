@@ -0,0 +1,201 @@
+# this file contains the command line and python api of the calcium score export, it runs without 3D Slicer
+# usage (from the CACSLabeler folder): python -m CACSLabelerLib --help
+
+import argparse
+import os
+
+from .SettingsHandler import SettingsHandler
+from .CalciumScore import CalciumScore, exportTypesOrder
+
+segmentationModes = exportTypesOrder
+
+def datasetInformationFromSettings(settingsHandler, dataset, observer):
+    # same order as CACSLabelerWidget.selectedDatasetAndObserverSetting
+    imagesPath = settingsHandler.getContentByKeys(["datasets", dataset, "imagesPath"])
+    labelsPath = settingsHandler.getContentByKeys(["datasets", dataset, "observers", observer, "labelsPath"])
+    segmentationMode = settingsHandler.getContentByKeys(["datasets", dataset, "observers", observer, "segmentationMode"])
+    sliceStepFile = settingsHandler.getContentByKeys(["datasets", dataset, "sliceStepFile"])
+    exportFolder = settingsHandler.getContentByKeys(["exportFolder"])
+    labelFileSuffix = settingsHandler.getContentByKeys(["datasets", dataset, "observers", observer, "labelFileSuffix"])
+
+    return imagesPath, labelsPath, segmentationMode, sliceStepFile, exportFolder, dataset, observer, labelFileSuffix
+
+def exportCalciumScores(imagesPath, labelsPath, segmentationMode, sliceStepFile, exportFolder, dataset, observer, labelFileSuffix,
+                        exportType=None, fromJson=False, settingsFilepath=None, settings=None, shard=None, fileList=None, partName=None,
+                        merge=False, partNames=None, exportTypes=None, observers=None):
+    # settings overrides (e.g. {"exportWorkers": 4}) are only used for this export and not saved
+    # exportTypes: several export types from one pass, the finest one is calculated and the others derived from the same read
+    # observers: dataset information of further observers, their label files are scored with the same image reads
+    settingsHandler = SettingsHandler(settingsFilepath)
+
+    for key, value in (settings or {}).items():
+        settingsHandler.changeContentByKey([key], value, save=False)
+
+    os.makedirs(exportFolder, exist_ok=True)
+
+    derivedExportTypes = None
+
+    if exportTypes:
+        exportTypes = sorted(exportTypes, key=exportTypesOrder.index, reverse=True)
+        exportType, derivedExportTypes = exportTypes[0], exportTypes[1:]
+
+    datasetInformation = (imagesPath, labelsPath, segmentationMode, sliceStepFile, exportFolder, dataset, observer, labelFileSuffix)
+    exporter = CalciumScore(datasetInformation, exportType=exportType, settingsHandler=settingsHandler, shard=shard,
+                            fileList=fileList, partName=partName, derivedExportTypes=derivedExportTypes,
+                            observerDatasetInformations=observers)
+
+    if merge:
+        for export in exporter.allExports():
+            if not export.mergePartialExports(partNames):
+                raise ValueError("Partial exports of " + export.observer + " " + export.exportType + " are incomplete or contain duplicate series")
+    elif fromJson:
+        for export in exporter.allExports():
+            export.exportFromJSONFile()
+    else:
+        exporter.exportFromReferenceFolder()
+
+    if (merge or fromJson) and len(exporter.observerExports) > 0:
+        exporter.createObserversTable()
+
+    return exporter
+
+def observerDatasetInformations(settingsHandler, dataset, observer, imagesPath, sliceStepFile, exportFolder):
+    # all other observers of the dataset with labels, images and slice steps are the ones of the exported observer
+    observers = []
+
+    for otherObserver in settingsHandler.getContentByKeys(["datasets", dataset, "observers"]) or {}:
+        if otherObserver == observer:
+            continue
+
+        _, labelsPath, segmentationMode, _, _, _, _, labelFileSuffix = datasetInformationFromSettings(settingsHandler, dataset, otherObserver)
+
+        if not labelsPath or not os.path.isdir(labelsPath) or not labelFileSuffix or segmentationMode not in segmentationModes:
+            print("Skipping observer", otherObserver, "without labels path, label file suffix or segmentation mode")
+            continue
+
+        observers.append((imagesPath, labelsPath, segmentationMode, sliceStepFile, exportFolder, dataset, otherObserver, labelFileSuffix))
+
+    return observers
+
+def parseShard(value):
+    # "i/N" => (i, N), i counts from 0
+    try:
+        shardIndex, shardCount = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/N, e.g. 0/8")
+
+    if shardCount < 1 or not 0 <= shardIndex < shardCount:
+        raise argparse.ArgumentTypeError("expected 0 <= i < N")
+
+    return shardIndex, shardCount
+
+def readFileList(filepath):
+    with open(filepath, 'r', encoding='utf-8') as file:
+        return [line.strip() for line in file if line.strip()]
+
+def createArgumentParser():
+    parser = argparse.ArgumentParser(prog="CACSLabelerLib", description="Calcium score export without 3D Slicer. "
+                                     "Paths that are not given are read from the dataset and observer in the settings file.")
+
+    parser.add_argument("--settings", help="settings json, default: data/settings_CACSLabeler5.x.json or $CACSLABELER_SETTINGS")
+    parser.add_argument("--dataset", required=True, help="dataset name, used for the export file names")
+    parser.add_argument("--observer", required=True, help="observer name, used for the export file names")
+    parser.add_argument("--all-observers", action="store_true",
+                        help="also score the label files of all other observers of the dataset with the same image reads, "
+                             "one csv/json per observer and a combined <dataset>_observers.csv")
+    parser.add_argument("--images", help="folder with the .mhd images")
+    parser.add_argument("--labels", help="folder with the label files of the observer")
+    parser.add_argument("--label-suffix", help="label file suffix, e.g. --label-suffix=-label.nrrd")
+    parser.add_argument("--segmentation-mode", choices=segmentationModes, help="segmentation type of the labels")
+    parser.add_argument("--export-type", choices=segmentationModes, help="exported segmentation type, default: exportType setting")
+    parser.add_argument("--export-types", nargs="+", choices=segmentationModes,
+                        help="several exported segmentation types from one pass over the images, one csv/json per type")
+    parser.add_argument("--slice-step-file", help="csv with patient_id, series_instance_uid, slice_thickness and slice_step")
+    parser.add_argument("--export-folder", help="output folder of the csv and json export")
+    parser.add_argument("--from-json", action="store_true", help="recalculate the scores from an existing json export")
+    parser.add_argument("--workers", type=int, help="export workers, 0 = one per cpu")
+    parser.add_argument("--threads", action="store_true", help="use threads instead of processes for the workers")
+    parser.add_argument("--no-cache", action="store_true", help="do not use the lesion result cache")
+    parser.add_argument("--agatston-sweep", nargs="+", type=float, metavar="HU",
+                        help="additional Agatston scores at these thresholds, e.g. 100 110 150, default: agatstonSweep setting")
+    parser.add_argument("--shard", type=parseShard, help="only export shard i of N (i/N, i from 0), selected by a stable hash of the label filename")
+    parser.add_argument("--file-list", help="only export the label files listed in this file, one filename per line")
+    parser.add_argument("--part-name", help="name of the partial export of --file-list, default: name of the list file")
+    parser.add_argument("--merge", action="store_true", help="combine the partial exports into the final csv/json")
+    parser.add_argument("--parts", nargs="+", help="partial exports to merge, default: all found in the export folder")
+
+    return parser
+
+def main(argv=None):
+    parser = createArgumentParser()
+    arguments = parser.parse_args(argv)
+
+    settingsHandler = SettingsHandler(arguments.settings)
+    imagesPath, labelsPath, segmentationMode, sliceStepFile, exportFolder, dataset, observer, labelFileSuffix = datasetInformationFromSettings(settingsHandler, arguments.dataset, arguments.observer)
+
+    imagesPath = arguments.images or imagesPath
+    labelsPath = arguments.labels or labelsPath
+    labelFileSuffix = arguments.label_suffix if arguments.label_suffix is not None else labelFileSuffix
+    segmentationMode = arguments.segmentation_mode or segmentationMode
+    sliceStepFile = arguments.slice_step_file or sliceStepFile
+    exportFolder = arguments.export_folder or exportFolder
+
+    missing = [name for name, value in [("--images", imagesPath), ("--labels", labelsPath), ("--label-suffix", labelFileSuffix),
+                                        ("--segmentation-mode", segmentationMode), ("--slice-step-file", sliceStepFile),
+                                        ("--export-folder", exportFolder)] if not value]
+
+    if arguments.from_json or arguments.merge:
+        # the json export and the merge only need the segmentation mode and the export folder
+        missing = [name for name in missing if name in ("--segmentation-mode", "--export-folder")]
+
+    if len(missing) > 0:
+        parser.error("missing " + ", ".join(missing) + " (not given and not in the settings of the dataset/observer)")
+
+    if segmentationMode not in segmentationModes:
+        parser.error("invalid segmentation mode " + segmentationMode)
+
+    if arguments.shard is not None and arguments.file_list is not None:
+        parser.error("--shard and --file-list cannot be combined")
+
+    if arguments.export_type is not None and arguments.export_types is not None:
+        parser.error("--export-type and --export-types cannot be combined")
+
+    fileList = None
+    partName = arguments.part_name
+
+    if arguments.file_list is not None:
+        fileList = readFileList(arguments.file_list)
+        partName = partName or os.path.splitext(os.path.basename(arguments.file_list))[0]
+
+    observers = None
+
+    if arguments.all_observers:
+        observers = observerDatasetInformations(settingsHandler, dataset, observer, imagesPath, sliceStepFile, exportFolder)
+
+    settings = {}
+
+    if arguments.workers is not None:
+        settings["exportWorkers"] = arguments.workers
+    # outside of 3D Slicer the workers are processes unless --threads is given
+    settings["exportUseProcesses"] = not arguments.threads
+    if arguments.no_cache:
+        settings["exportCache"] = False
+    if arguments.agatston_sweep:
+        settings["agatstonSweep"] = [{"name": "{:g}HU".format(threshold), "threshold": threshold} for threshold in arguments.agatston_sweep]
+
+    try:
+        exporter = exportCalciumScores(imagesPath, labelsPath, segmentationMode, sliceStepFile, exportFolder, dataset, observer, labelFileSuffix,
+                                       exportType=arguments.export_type, fromJson=arguments.from_json, settingsFilepath=arguments.settings,
+                                       settings=settings, shard=arguments.shard, fileList=fileList, partName=partName,
+                                       merge=arguments.merge, partNames=arguments.parts, exportTypes=arguments.export_types,
+                                       observers=observers)
+    except ValueError as error:
+        parser.exit(1, str(error) + "\n")
+
+    for export in exporter.allExports():
+        print("Exported to", export.filepaths["exportFileCSV"])
+
+    if len(exporter.observerExports) > 0:
+        print("Exported to", exporter.filepaths["exportFileObserversCSV"])
+
+    return 0
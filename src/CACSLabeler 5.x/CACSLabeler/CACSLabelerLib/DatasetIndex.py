@@ -0,0 +1,132 @@
+# this class contains the images and label files of a dataset observer for the image list and the progress bar
+# folders are only scanned again after their modification time changed, saved labels are added without a scan
+
+import os
+import csv
+
+imageFileExtension = ".mhd"
+segmentationFileExtension = ".nrrd"
+
+class DatasetIndex():
+    def __init__(self, imagesPath, labelsPath, labelFileSuffix, includedImageFilter=None):
+        self.imagesPath = imagesPath
+        self.labelsPath = labelsPath
+        self.labelFileSuffix = labelFileSuffix
+        self.includedImageFilter = includedImageFilter or None
+
+        # image filename => image name
+        self.imageFiles = {}
+        # label name (label filename without suffix and extension) => label filenames
+        self.labelFiles = {}
+        self.includedFiles = None
+
+        self.modificationTimes = {}
+        self.sortedImageFiles = None
+
+        self.refresh()
+
+    def modificationTime(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def isOutdated(self, path):
+        return self.modificationTimes.get(path, -1) != self.modificationTime(path)
+
+    def refresh(self):
+        # scans only the folders and the filter file that changed since the last refresh
+        if self.isOutdated(self.imagesPath):
+            self.scanImages()
+
+        if self.isOutdated(self.labelsPath):
+            self.scanLabels()
+
+        if self.includedImageFilter is not None and self.isOutdated(self.includedImageFilter):
+            self.readIncludedImageFilter()
+
+    def regularFiles(self, path):
+        with os.scandir(path) as entries:
+            return [entry.name for entry in entries if entry.is_file()]
+
+    def scanImages(self):
+        self.modificationTimes[self.imagesPath] = self.modificationTime(self.imagesPath)
+        self.imageFiles = {}
+        self.sortedImageFiles = None
+
+        for imageFileName in self.regularFiles(self.imagesPath):
+            name, extension = os.path.splitext(imageFileName)
+
+            if extension == imageFileExtension:
+                self.imageFiles[imageFileName] = name
+
+    def scanLabels(self):
+        self.modificationTimes[self.labelsPath] = self.modificationTime(self.labelsPath)
+        self.labelFiles = {}
+
+        for labelFileName in self.regularFiles(self.labelsPath):
+            self.addLabelFile(labelFileName)
+
+    def readIncludedImageFilter(self):
+        self.modificationTimes[self.includedImageFilter] = self.modificationTime(self.includedImageFilter)
+
+        with open(self.includedImageFilter, 'r', encoding='utf-8-sig', newline='') as file:
+            self.includedFiles = set(row["Filename"] for row in csv.DictReader(file))
+
+    def labelName(self, labelFileName):
+        name, extension = os.path.splitext(labelFileName)
+
+        if extension != segmentationFileExtension:
+            return None
+
+        if self.labelFileSuffix:
+            return name.split(self.labelFileSuffix)[0]
+
+        return name
+
+    def addLabelFile(self, labelFileName):
+        name = self.labelName(labelFileName)
+
+        if name is not None:
+            self.labelFiles.setdefault(name, set()).add(labelFileName)
+
+    def addLabel(self, labelFileName):
+        # called after saving a label, the folder change of the save is taken over without scanning the folder again
+        self.addLabelFile(labelFileName)
+        self.modificationTimes[self.labelsPath] = self.modificationTime(self.labelsPath)
+
+    def isLabeled(self, name):
+        return name in self.labelFiles
+
+    def imageList(self):
+        self.refresh()
+
+        if self.sortedImageFiles is None:
+            self.sortedImageFiles = sorted(self.imageFiles)
+
+        files = {"allImages": [], "unlabeledImages": []}
+
+        for imageFileName in self.sortedImageFiles:
+            if self.includedFiles is not None and imageFileName not in self.includedFiles:
+                continue
+
+            name = self.imageFiles[imageFileName]
+            files["allImages"].append(name)
+
+            if name not in self.labelFiles:
+                files["unlabeledImages"].append(name)
+
+        return files
+
+# shared between all views of a session, keyed by the folders, the label file suffix and the filter file
+datasetIndices = {}
+
+def loadDatasetIndex(imagesPath, labelsPath, labelFileSuffix, includedImageFilter=None):
+    key = (os.path.abspath(imagesPath), os.path.abspath(labelsPath), labelFileSuffix, includedImageFilter or None)
+    index = datasetIndices.get(key)
+
+    if index is None:
+        index = DatasetIndex(imagesPath, labelsPath, labelFileSuffix, includedImageFilter)
+        datasetIndices[key] = index
+
+    return index
@@ -0,0 +1,78 @@
+# this class contains a read-only index of labels.json, built once so label lookups do not walk the settings json
+
+from types import MappingProxyType
+import hashlib
+import json
+import numpy
+
+class LabelIndex():
+    def __init__(self, labels, exportedLabels):
+        # kept to rebuild the index when it is sent to export worker processes
+        self.labels = labels
+        self.exportedLabelsSource = exportedLabels
+
+        valuesByName = {}
+        namesByValue = {}
+        colorsByName = {}
+
+        for segmentationType, segmentationLabels in labels.items():
+            valuesByName[segmentationType] = MappingProxyType({name: label["value"] for name, label in segmentationLabels.items()})
+            namesByValue[segmentationType] = MappingProxyType({label["value"]: name for name, label in segmentationLabels.items()})
+            colorsByName[segmentationType] = MappingProxyType({name: self.parseColor(label["color"]) for name, label in segmentationLabels.items()})
+
+        self.valuesByName = MappingProxyType(valuesByName)
+        self.namesByValue = MappingProxyType(namesByValue)
+        self.colorsByName = MappingProxyType(colorsByName)
+
+        resolvedExportedLabels = {}
+
+        for exportType, items in exportedLabels.items():
+            values = valuesByName.get(exportType, {})
+            resolvedItems = {}
+
+            for item, content in items.items():
+                if isinstance(content, list):
+                    # groups become value arrays, names missing in labels.json are skipped
+                    group = numpy.array([values[name] for name in content if name in values], dtype=int)
+                    group.flags.writeable = False
+                    resolvedItems[item] = group
+                else:
+                    resolvedItems[item] = values.get(content)
+
+            resolvedExportedLabels[exportType] = MappingProxyType(resolvedItems)
+
+        self.exportedLabels = MappingProxyType(resolvedExportedLabels)
+
+        # identifies the label definitions, e.g. for cached results that depend on label values or export groups
+        self.digest = hashlib.sha1(json.dumps([labels, exportedLabels], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def parseColor(self, color):
+        # "#rrggbb" or "#rgb" => (r, g, b) in 0-255
+        color = color.lstrip("#")
+
+        if len(color) == 3:
+            color = "".join(character * 2 for character in color)
+
+        return tuple(int(color[i:i + 2], 16) for i in (0, 2, 4))
+
+    def labelValue(self, segmentationType, name):
+        return self.valuesByName.get(segmentationType, {}).get(name)
+
+    def labelName(self, segmentationType, value):
+        return self.namesByValue.get(segmentationType, {}).get(value)
+
+    def labelColor(self, segmentationType, name):
+        return self.colorsByName.get(segmentationType, {}).get(name)
+
+    def labelValues(self, segmentationType):
+        return self.valuesByName.get(segmentationType, MappingProxyType({}))
+
+    def exportedLabelValues(self, exportType):
+        return self.exportedLabels.get(exportType, MappingProxyType({}))
+
+    def __getstate__(self):
+        # mapping proxies cannot be pickled
+        return {"labels": self.labels, "exportedLabels": self.exportedLabelsSource}
+
+    def __setstate__(self, state):
+        self.__init__(state["labels"], state["exportedLabels"])
@@ -0,0 +1,122 @@
+# this class contains the persistent on-disk cache of per-series lesion results used by the calcium score export
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy
+
+# increase when the content of cached lesion tables changes, invalidates all existing entries
+cacheVersion = 1
+
+def dataFiles(filepath):
+    # .mhd headers keep the voxel data in a separate file
+    if not filepath.endswith(".mhd") or not os.path.isfile(filepath):
+        return []
+
+    with open(filepath, 'r', encoding='utf-8', errors='ignore') as file:
+        for line in file:
+            key, _, value = line.partition("=")
+
+            if key.strip() == "ElementDataFile":
+                value = value.strip()
+
+                if value in ("LOCAL", "LIST") or value.startswith("LIST"):
+                    return []
+
+                return [os.path.join(os.path.dirname(filepath), value)]
+
+    return []
+
+class ResultCache():
+    def __init__(self, cacheFolder, maxSizeInBytes, useHash=False):
+        self.cacheFolder = cacheFolder
+        self.maxSizeInBytes = maxSizeInBytes
+        self.useHash = useHash
+
+        os.makedirs(self.cacheFolder, exist_ok=True)
+
+    def fileIdentity(self, filepath):
+        identity = []
+
+        for path in [filepath] + self.dataFiles(filepath):
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                entry = [os.path.basename(path), stat.st_size, stat.st_mtime_ns]
+
+                if self.useHash:
+                    entry.append(self.fileHash(path))
+
+                identity.append(entry)
+            else:
+                identity.append([os.path.basename(path), None])
+
+        return identity
+
+    def dataFiles(self, filepath):
+        return dataFiles(filepath)
+
+    def fileHash(self, filepath):
+        sha = hashlib.sha1()
+
+        with open(filepath, 'rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                sha.update(block)
+
+        return sha.hexdigest()
+
+    def createKey(self, filepaths, parameters):
+        content = [cacheVersion, [self.fileIdentity(filepath) for filepath in filepaths], parameters]
+        return hashlib.sha1(json.dumps(content, default=str).encode('utf-8')).hexdigest()
+
+    def entryPath(self, key):
+        return os.path.join(self.cacheFolder, key + ".npz")
+
+    def load(self, key):
+        path = self.entryPath(key)
+
+        try:
+            with numpy.load(path) as entry:
+                seriesJson = json.loads(str(entry["seriesJson"]))
+                lesionTable = entry["lesionTable"]
+
+            # marks the entry as recently used for the eviction
+            os.utime(path)
+
+            return seriesJson, lesionTable
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, key, seriesJson, lesionTable, jsonEncoder=None):
+        # written to a temporary file first, so concurrent workers never read a partial entry
+        fileDescriptor, temporaryPath = tempfile.mkstemp(dir=self.cacheFolder, suffix=".tmp")
+
+        try:
+            with os.fdopen(fileDescriptor, 'wb') as file:
+                numpy.savez(file, seriesJson=numpy.array(json.dumps(seriesJson, cls=jsonEncoder)), lesionTable=lesionTable)
+
+            os.replace(temporaryPath, self.entryPath(key))
+        except OSError:
+            if os.path.isfile(temporaryPath):
+                os.remove(temporaryPath)
+
+    def prune(self):
+        # removes least recently used entries until the cache fits into maxSizeInBytes
+        entries = []
+
+        for entry in os.scandir(self.cacheFolder):
+            if entry.is_file() and entry.name.endswith(".npz"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        totalSize = sum(entry[1] for entry in entries)
+
+        for mtime, size, path in sorted(entries):
+            if totalSize <= self.maxSizeInBytes:
+                break
+
+            try:
+                os.remove(path)
+                totalSize -= size
+            except OSError:
+                pass
@@ -3,6 +3,72 @@
 import numpy
 from .SettingsHandler import SettingsHandler
 
+# compiled lookup tables, keyed by (conversion, dtype)
+# conversions contain the digest of the label definitions, so changed labels compile new tables
+lookupTables = {}
+
+def hasLookupTableDomain(dtype):
+    # dense lookup tables are used for 8 and 16 bit integer label images
+    dtype = numpy.dtype(dtype)
+    return dtype.kind in "iu" and dtype.itemsize <= 2
+
+def lookupTableDomain(dtype):
+    # every value of the dtype, ordered by its unsigned bit pattern so that label.view(unsigned) indexes the table
+    dtype = numpy.dtype(dtype)
+    return numpy.arange(2 ** (8 * dtype.itemsize), dtype="u" + str(dtype.itemsize)).view(dtype)
+
+def getLookupTable(conversion, dtype, remap):
+    # remap is run once on all values of the dtype, None if the conversion is not possible
+    key = (conversion, numpy.dtype(dtype).str)
+
+    if key not in lookupTables:
+        lookupTables[key] = remap(lookupTableDomain(dtype))
+
+    return lookupTables[key]
+
+def applyLookupTable(lookupTable, segmentation, inPlace=True, slabSize=None):
+    indices = segmentation.view("u" + str(segmentation.dtype.itemsize))
+
+    if not inPlace:
+        return lookupTable[indices]
+
+    # slabs along the first axis limit the temporary memory of the gather
+    slabSize = slabSize or len(segmentation)
+
+    for start in range(0, len(segmentation), slabSize):
+        segmentation[start:start + slabSize] = lookupTable[indices[start:start + slabSize]]
+
+    return segmentation
+
+def remapSegmentation(segmentation, conversion, remap, inPlace=True, slabSize=None):
+    # applies the value mapping of remap to segmentation in one memory pass
+    # read only segmentations (e.g. of the volume cache) have to be converted with inPlace=False
+    if inPlace and not segmentation.flags.writeable:
+        raise ValueError("Read only segmentation cannot be converted in place, use inPlace=False")
+
+    if hasLookupTableDomain(segmentation.dtype):
+        lookupTable = getLookupTable(conversion, segmentation.dtype, remap)
+
+        if lookupTable is None:
+            return None
+
+        return applyLookupTable(lookupTable, segmentation, inPlace, slabSize)
+
+    # other dtypes are mapped through their unique values
+    values, inverse = numpy.unique(segmentation, return_inverse=True)
+    values = remap(values)
+
+    if values is None:
+        return None
+
+    remapped = values[inverse].reshape(segmentation.shape)
+
+    if not inPlace:
+        return remapped
+
+    segmentation[...] = remapped
+    return segmentation
+
 class SegmentationProcessor():
     def __init__(self):
         self.settingsHandler = SettingsHandler()
@@ -17,9 +83,21 @@ class SegmentationProcessor():
         return self.availableSegmentationTypes[:self.availableSegmentationTypes.index(segmentationType) + 1]
 
     def getLabelValueByName(self, segmentationType, name):
-        return self.settingsHandler.getContentByKeys(["labels", segmentationType, name, "value"])
+        return self.settingsHandler.getLabelValue(segmentationType, name)
 
-    def convert(self, segmentation, oldSegmentationType, newSegmentationType):
+    def convert(self, segmentation, oldSegmentationType, newSegmentationType, inPlace=True, slabSize=None):
+        # the conversion is compiled once per type pair, label definitions and dtype into a lookup table
+        remap = lambda values: self.remapLabelValues(values, oldSegmentationType, newSegmentationType)
+        conversion = ("convert", oldSegmentationType, newSegmentationType, self.settingsHandler.labelIndex.digest)
+        convertedSegmentation = remapSegmentation(segmentation, conversion, remap, inPlace, slabSize)
+
+        if convertedSegmentation is None:
+            print("Error! Segmentation cannot be converted! Check type!")
+
+        return convertedSegmentation
+
+    def remapLabelValues(self, segmentation, oldSegmentationType, newSegmentationType):
+        # definition of all conversions, only used to compile the lookup tables
         if oldSegmentationType == "SegmentLevelDLNExport":
             segmentation[segmentation == 1] = 0
         else:
@@ -241,13 +319,10 @@ class SegmentationProcessor():
                 segmentation[segmentation == self.getLabelValueByName(oldSegmentationType, "L_PDA_16a") + 100] = self.getLabelValueByName(newSegmentationType, "LCX")
                 segmentation[segmentation == self.getLabelValueByName(oldSegmentationType, "L_PLB_16b") + 100] = self.getLabelValueByName(newSegmentationType, "LCX")
 
-                print(numpy.unique(segmentation))
-
             return segmentation
 
         elif oldSegmentationType == newSegmentationType:
             return segmentation
 
         else:
-            print("Error! Segmentation cannot be converted! Check type!")
-            return
\ No newline at end of file
+            return None
\ No newline at end of file
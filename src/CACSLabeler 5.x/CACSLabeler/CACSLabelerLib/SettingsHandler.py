@@ -5,14 +5,27 @@ from pathlib import Path
 from functools import reduce
 from operator import getitem
 
+from .LabelIndex import LabelIndex
+
 class SettingsHandler():
-    def __init__(self):
-        self.settingsFolderpath = os.path.join(Path(__file__).absolute().parent.parent.parent.parent.parent, "data")
-        self.settingsFilepath = os.path.join(self.settingsFolderpath, "settings_CACSLabeler5.x.json")
+    def __init__(self, settingsFilepath=None):
+        # settings file can be set for runs outside of 3D Slicer, default is the data folder of the repository
+        if settingsFilepath is None:
+            settingsFilepath = os.environ.get("CACSLABELER_SETTINGS")
+
+        if settingsFilepath is None:
+            self.settingsFolderpath = os.path.join(Path(__file__).absolute().parent.parent.parent.parent.parent, "data")
+            self.settingsFilepath = os.path.join(self.settingsFolderpath, "settings_CACSLabeler5.x.json")
+        else:
+            self.settingsFilepath = os.path.abspath(settingsFilepath)
+            self.settingsFolderpath = os.path.dirname(self.settingsFilepath)
 
         # Holds read settings json!
         self.settingsJson = None
 
+        # Read-only index of the labels, rebuilt when the labels change
+        self.labelIndex = None
+
         # checking if settings json exists otherwise creating new settings file!
         if os.path.isfile(self.settingsFilepath):
             self.settingsJson = self.readFile(self.settingsFilepath)
@@ -35,6 +48,26 @@ class SettingsHandler():
             self.settingsJson["labels"] = json["labels"]
             self.settingsJson["exportedLabels"] = json["exportedLabels"]
 
+        self.createLabelIndex()
+
+    def createLabelIndex(self):
+        self.labelIndex = LabelIndex(self.settingsJson.get("labels", {}), self.settingsJson.get("exportedLabels", {}))
+
+    def getLabelValue(self, segmentationType, name):
+        return self.labelIndex.labelValue(segmentationType, name)
+
+    def getLabelName(self, segmentationType, value):
+        return self.labelIndex.labelName(segmentationType, value)
+
+    def getLabelColor(self, segmentationType, name):
+        return self.labelIndex.labelColor(segmentationType, name)
+
+    def getLabelValues(self, segmentationType):
+        return self.labelIndex.labelValues(segmentationType)
+
+    def getExportedLabelValues(self, exportType):
+        return self.labelIndex.exportedLabelValues(exportType)
+
     def deleteLabelsFromSettingsFile(self, settings):
         if "labels" in settings:
             del settings["labels"]
@@ -52,6 +85,7 @@ class SettingsHandler():
 
         if os.path.isfile(defaultSettingsPath):
             self.settingsJson = self.readFile(defaultSettingsPath)
+            os.makedirs(self.settingsFolderpath, exist_ok=True)
             self.saveFile()
 
     def saveFile(self):
@@ -62,23 +96,23 @@ class SettingsHandler():
             json.dump(settings, file, indent=4)
 
     def getContentByKeys(self, keys):
-        data = None
+        if len(keys) == 0:
+            return None
 
         try:
-            for key in keys:
-                if data is None:
-                    data = self.settingsJson.copy()
-                    data = data[key]
-                else:
-                    data = data[key]
-
-            return data
+            return reduce(getitem, keys, self.settingsJson)
         except KeyError:
             return None
 
-    def changeContentByKey(self, keys, value):
+    def changeContentByKey(self, keys, value, save=True):
+        # save=False only changes the setting for this instance, e.g. command line overrides
         reduce(getitem, keys[:-1], self.settingsJson)[keys[-1]] = value
-        self.saveFile()
+
+        if keys[0] in ("labels", "exportedLabels"):
+            self.createLabelIndex()
+
+        if save:
+            self.saveFile()
 
     def setDefaultDatasetAndObserver(self):
         dataset = self.getContentByKeys(["savedDatasetAndObserverSelection", "dataset"])
@@ -0,0 +1,95 @@
+# this class contains the slice thickness and slice step of every series of the slice step csv file
+# the file is parsed once, lookups are dictionary accesses keyed by SeriesInstanceUID and PatientID_SeriesInstanceUID
+
+import os
+import csv
+
+class SliceStepIndex():
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.modificationTime = None
+
+        self.seriesEntries = {}
+        self.nameEntries = {}
+        self.duplicateSeries = set()
+        self.invalidRows = []
+
+        self.load()
+
+    def load(self):
+        self.modificationTime = os.stat(self.filepath).st_mtime_ns
+
+        self.seriesEntries = {}
+        self.nameEntries = {}
+        self.duplicateSeries = set()
+        self.invalidRows = []
+
+        with open(self.filepath, 'r', encoding='utf-8-sig', newline='') as file:
+            for rowNumber, row in enumerate(csv.DictReader(file), start=2):
+                patientID = (row.get("patient_id") or "").strip()
+                seriesInstanceUID = (row.get("series_instance_uid") or "").strip()
+
+                try:
+                    entry = (float(row["slice_thickness"]), self.parseSliceStep(row["slice_step"]))
+                except (KeyError, TypeError, ValueError):
+                    self.invalidRows.append(rowNumber)
+                    continue
+
+                if seriesInstanceUID in self.seriesEntries and self.seriesEntries[seriesInstanceUID] != entry:
+                    self.duplicateSeries.add(seriesInstanceUID)
+
+                self.seriesEntries[seriesInstanceUID] = entry
+                self.nameEntries[patientID + "_" + seriesInstanceUID] = entry
+
+    def parseSliceStep(self, value):
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+
+    def isOutdated(self):
+        try:
+            return os.stat(self.filepath).st_mtime_ns != self.modificationTime
+        except OSError:
+            return True
+
+    def lookup(self, patientID, seriesInstanceUID):
+        # returns (sliceThickness, sliceStep) or None, an ambiguous SeriesInstanceUID is only resolved together with the PatientID
+        name = patientID + "_" + seriesInstanceUID
+
+        if name in self.nameEntries:
+            return self.nameEntries[name]
+
+        if seriesInstanceUID in self.duplicateSeries:
+            return None
+
+        return self.seriesEntries.get(seriesInstanceUID)
+
+    def validate(self, series):
+        # series: list of (PatientID, SeriesInstanceUID), returns the missing and ambiguous ones
+        missing = []
+        ambiguous = []
+
+        for patientID, seriesInstanceUID in series:
+            if self.lookup(patientID, seriesInstanceUID) is not None:
+                continue
+
+            if seriesInstanceUID in self.duplicateSeries:
+                ambiguous.append((patientID, seriesInstanceUID))
+            else:
+                missing.append((patientID, seriesInstanceUID))
+
+        return missing, ambiguous
+
+# shared between all exports of a session, a file is only parsed again after it changed
+sliceStepIndices = {}
+
+def loadSliceStepIndex(filepath):
+    filepath = os.path.abspath(filepath)
+    index = sliceStepIndices.get(filepath)
+
+    if index is None or index.isOutdated():
+        index = SliceStepIndex(filepath)
+        sliceStepIndices[filepath] = index
+
+    return index
@@ -0,0 +1,134 @@
+# this class keeps the decoded images and label files of a labeling session in memory, least recently used volumes are removed first
+# entries are keyed by the absolute path, size and modification time of the files, so changed files are read again
+# the cached arrays are read only, callers that change a volume have to copy it first
+
+import os
+import threading
+from collections import OrderedDict
+
+import SimpleITK as sitk
+
+from .ResultCache import dataFiles
+
+class VolumeCache():
+    def __init__(self, maxSizeInBytes):
+        self.maxSizeInBytes = maxSizeInBytes
+
+        # key => (array, geometry), most recently used last
+        self.entries = OrderedDict()
+        self.sizeInBytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        # the case prefetcher and the export readers use the cache from other threads
+        self.lock = threading.Lock()
+
+    def fileKey(self, filepath):
+        key = []
+
+        for path in [os.path.abspath(filepath)] + dataFiles(filepath):
+            stat = os.stat(path)
+            key.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+
+        return tuple(key)
+
+    def read(self, filepath, store=True):
+        # (array in z,y,x order, geometry), store=False only uses volumes that are already cached
+        key = self.fileKey(filepath)
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+            self.misses += 1
+
+        image = sitk.ReadImage(filepath)
+        array = sitk.GetArrayFromImage(image)
+        array.setflags(write=False)
+
+        entry = (array, {"spacing": image.GetSpacing(), "origin": image.GetOrigin(), "direction": image.GetDirection()})
+
+        if store:
+            self.add(key, entry)
+
+        return entry
+
+    def readArray(self, filepath, store=True):
+        return self.read(filepath, store)[0]
+
+    def readImage(self, filepath, store=True):
+        array, geometry = self.read(filepath, store)
+
+        image = sitk.GetImageFromArray(array)
+        image.SetSpacing(geometry["spacing"])
+        image.SetOrigin(geometry["origin"])
+        image.SetDirection(geometry["direction"])
+
+        return image
+
+    def add(self, key, entry):
+        size = entry[0].nbytes
+
+        if size > self.maxSizeInBytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                return
+
+            # older versions of a changed file are never used again
+            for oldKey in [oldKey for oldKey in self.entries if oldKey[0][0] == key[0][0]]:
+                self.remove(oldKey)
+
+            self.entries[key] = entry
+            self.sizeInBytes += size
+
+            while self.sizeInBytes > self.maxSizeInBytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        array, _ = self.entries.pop(key)
+        self.sizeInBytes -= array.nbytes
+
+    def resize(self, maxSizeInBytes):
+        with self.lock:
+            self.maxSizeInBytes = maxSizeInBytes
+
+            while self.sizeInBytes > self.maxSizeInBytes:
+                self.remove(next(iter(self.entries)))
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.sizeInBytes = 0
+
+    def statistics(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "volumes": len(self.entries), "sizeInBytes": self.sizeInBytes}
+
+# shared by the widget, the case prefetcher and exports of the same process
+sessionVolumeCache = None
+
+def loadVolumeCache(maxSizeInBytes):
+    # None if the cache is disabled (size 0)
+    global sessionVolumeCache
+
+    if maxSizeInBytes <= 0:
+        if sessionVolumeCache is not None:
+            sessionVolumeCache.clear()
+
+        sessionVolumeCache = None
+    elif sessionVolumeCache is None:
+        sessionVolumeCache = VolumeCache(maxSizeInBytes)
+    elif sessionVolumeCache.maxSizeInBytes != maxSizeInBytes:
+        sessionVolumeCache.resize(maxSizeInBytes)
+
+    return sessionVolumeCache
+
+def currentVolumeCache():
+    return sessionVolumeCache
@@ -25,6 +25,7 @@ from CalciumScores.DensityScore import DensityScore
 from CalciumScores.NumLesions import NumLesions
 from CalciumScores.LesionVolume import LesionVolume
 from CalciumScores.CalciumScoreBase import CalciumScoreBase
+from CalciumScores.LesionAnalysis import LesionAnalysis
 
 from collections import defaultdict, OrderedDict
 import imp
@@ -110,17 +111,10 @@ class Image:
         self.arteries_dict = dict()
         self.arteries_sum = dict()
             
-    def findImage(self, images, dataset):
-        if dataset=='ORCASCORE':
-            for image in images:
-                _,name,_ = splitFilePath(image)
-                if self.image_name == name[0:-3]:
-                    self.fip_image = image
-        else:
-            for image in images:
-                _,name,_ = splitFilePath(image)
-                if self.image_name == name:
-                    self.fip_image = image
+    def findImage(self, dataset_index, dataset):
+        fip_image = dataset_index.findImage(self.image_name, dataset)
+        if fip_image is not None:
+            self.fip_image = fip_image
                 
     def setRef_name(self, ref_name):
         if len(ref_name.split('_'))==1:
@@ -149,6 +143,105 @@ class Image:
                 del self.scores[i]
                 return True
         return False            
+
+class SliceStepIndex:
+    def __init__(self, filepath_slice_step):
+        self.filepath_slice_step = filepath_slice_step
+        self.mtime = None
+        self.names = dict()
+        self.series = dict()
+        self.duplicates = set()
+        self.load()
+
+    def load(self):
+        # Parse slice step csv once (columns: patient, -, series, -, slice_thickness, slice_step)
+        self.mtime = os.stat(self.filepath_slice_step).st_mtime
+        self.names = dict()
+        self.series = dict()
+        self.duplicates = set()
+        with io.open(self.filepath_slice_step, 'r', encoding='utf-8-sig') as read_obj:
+            csv_reader = reader(read_obj)
+            for row in csv_reader:
+                if len(row)<6:
+                    continue
+                patient = row[0]
+                series = row[2]
+                name = patient + '_' + series
+                # First row of a name is used by extract_slice_step
+                if name not in self.names:
+                    self.names[name] = (row[5], row[4])
+                # Last row of a series is used by filterSliceThickness
+                if series in self.series:
+                    self.duplicates.add(series)
+                self.series[series] = row[4]
+        for series in sorted(self.duplicates):
+            print('Duplicate SeriesInstanceUID in slice_step csv file: ' + series)
+
+    def isOutdated(self, filepath_slice_step):
+        if filepath_slice_step!=self.filepath_slice_step:
+            return True
+        try:
+            return os.stat(self.filepath_slice_step).st_mtime!=self.mtime
+        except OSError:
+            return True
+
+    def slice_step(self, inputVolumeName):
+        if inputVolumeName not in self.names:
+            return None, None
+        slice_step, slice_thickness = self.names[inputVolumeName]
+        try:
+            return int(slice_step), float(slice_thickness)
+        except ValueError:
+            print('Type of slice_step is not integer!')
+            return 1, 3
+
+    def slice_thickness(self, series_image):
+        try:
+            return float(self.series[series_image])
+        except (KeyError, ValueError):
+            return None
+
+    def missing(self, imagelist):
+        return [image.image_name for image in imagelist if image.image_name not in self.names]
+            
+class DatasetIndex:
+    def __init__(self, fip_images=[], fip_references=[]):
+        # Image filepaths by image name (ORCASCORE: without the last 3 characters, e.g. CTI),
+        # a later file with the same name replaces an earlier one
+        self.images = dict()
+        self.images_orcascore = dict()
+        # Reference names and the reference suffixes per image name, e.g. 'P1_S1' -> {'-label', '-label-lesion'}
+        self.references = set()
+        self.reference_suffixes = dict()
+        for fip_image in fip_images:
+            self.addImage(fip_image)
+        for fip_ref in fip_references:
+            self.addReference(fip_ref)
+
+    def addImage(self, fip_image):
+        _,name,_ = splitFilePath(fip_image)
+        self.images[name] = fip_image
+        self.images_orcascore[name[0:-3]] = fip_image
+
+    def addReference(self, fip_ref):
+        _,name,_ = splitFilePath(fip_ref)
+        self.references.add(name)
+        # References are named <image name><suffix>, every part before a '-' can be the image name
+        self.reference_suffixes.setdefault(name, set()).add('')
+        for i,c in enumerate(name):
+            if c=='-':
+                self.reference_suffixes.setdefault(name[:i], set()).add(name[i:])
+
+    def findImage(self, image_name, dataset):
+        if dataset=='ORCASCORE':
+            return self.images_orcascore.get(image_name)
+        return self.images.get(image_name)
+
+    def hasReference(self, image_name, suffix):
+        return image_name + suffix in self.references
+
+    def referenceFound(self, image_name):
+        return image_name in self.reference_suffixes
             
 class CACSLabelerModule(ScriptedLoadableModule):
   """Uses ScriptedLoadableModule base class, available at:
@@ -182,6 +275,7 @@ class CACSLabelerModuleWidget:
         self.filepath_settings = None
         self.settings=Settings()
         self.imagelist=[]
+        self.slice_step_index=None
 
         if not parent:
             self.parent = slicer.qMRMLWidget()
@@ -401,27 +495,15 @@ class CACSLabelerModuleWidget:
         #print('arteries_sum', arteries_sum)
         return arteries_dict, arteries_sum
         
-    def extract_slice_step(self, inputVolumeName):
+    def get_slice_step_index(self):
+        # Slice step csv is only parsed again if the file or its path changed
         filepath_slice_step = self.settings['filepath_slice_step']
-        with io.open(filepath_slice_step, 'r', encoding='utf-8-sig') as read_obj:
-            csv_reader = reader(read_obj)
-            for row in csv_reader:
-                patient = row[0]
-                series = row[2]
-                name = patient + '_' + series
-                if name==inputVolumeName:
-                    try:
-                        slice_step = int(row[5])
-                        slice_thickness = float(row[4])
-                    except ValueError:
-                        print('Type of slice_step is not integer!')
-                        slice_step=1
-                        slice_thickness=3
-                    #print('row', row)
-                    #print('slice_stepXXX', slice_step)
-                    #print('slice_thicknessXXX', slice_thickness)
-                    return slice_step, slice_thickness
-        return None, None
+        if self.slice_step_index is None or self.slice_step_index.isOutdated(filepath_slice_step):
+            self.slice_step_index = SliceStepIndex(filepath_slice_step)
+        return self.slice_step_index
+
+    def extract_slice_step(self, inputVolumeName):
+        return self.get_slice_step_index().slice_step(inputVolumeName)
             
     def onScoreButtonClicked(self):
         # Get image and imageLabel
@@ -492,13 +574,22 @@ class CACSLabelerModuleWidget:
                 return inputVolumeName, PatientID, SeriesInstanceUID
         return None, None, None
         
-    def addScore(self, scorename, image):
+    def lesionAnalysis(self, image):
+        # Volumes are pulled from slicer and analysed once for all scores of an image
+        inputVolume = su.PullVolumeFromSlicer(image.image_name)
+        inputVolumeLabel = su.PullVolumeFromSlicer(image.ref_name)
+        return LesionAnalysis(inputVolume, inputVolumeLabel)
+
+    def addScore(self, scorename, image, analysis=None):
+        # optional settings for kV adjusted protocols: agatston_threshold and agatston_density_bands [[bound, weight], ...]
+        agatston_threshold = self.settings.settingsDict.get('agatston_threshold', lowerThresholdValue)
+        agatston_density_bands = self.settings.settingsDict.get('agatston_density_bands')
         if scorename=='AGATSTON_SCORE':
-            score = Agatston()
+            score = Agatston(agatston_threshold, agatston_density_bands)
         elif scorename=='VOLUME_SCORE':
             score = VolumeScore()
         elif scorename=='DENSITY_SCORE':
-            score = DensityScore()
+            score = DensityScore(agatston_threshold, agatston_density_bands)
         elif scorename=='NUMLESION_SCORE':
             score = NumLesions()
         elif scorename=='LESIONVOLUME_SCORE':
@@ -508,18 +599,21 @@ class CACSLabelerModuleWidget:
         
         image.deleteScore(scorename)
         if not image.scoreExist(scorename):
-            inputVolume = su.PullVolumeFromSlicer(image.image_name)
-            inputVolumeLabel = su.PullVolumeFromSlicer(image.ref_name)
+            if analysis is None:
+                analysis = self.lesionAnalysis(image)
             arteries_dict, arteries_sum = self.get_arteries_dict()
             slice_step, slice_thickness = self.extract_slice_step(image.image_name)
-            s = score.compute(inputVolume, inputVolumeLabel, arteries_dict, arteries_sum, slice_step, slice_thickness)
+            s = score.compute(None, None, arteries_dict, arteries_sum, slice_step, slice_thickness, analysis=analysis)
             image.scores.append(s)
         return image
         
     def onExportScoreButtonClicked(self, appendCSV=False):
+        for name in self.get_slice_step_index().missing(self.imagelist):
+            print('Image ' + name + ' is not in slice_step csv file!')
         for image in self.imagelist:
+            analysis = self.lesionAnalysis(image)
             for scorename in self.settings['CalciumScores']:
-                image = self.addScore(scorename, image)
+                image = self.addScore(scorename, image, analysis)
 
         # Export information
         print('Exporting:')
@@ -539,38 +633,30 @@ class CACSLabelerModuleWidget:
         fip_references = glob(folderpath_references + '/*lesion.nrrd') + glob(folderpath_references + '/*lesion-pred.nrrd') + glob(folderpath_references + '/*.mhd')
         fip_images = glob(self.settings['folderpath_images'] + '/*CTI.mhd') + glob(self.settings['folderpath_images'] + '/*.mhd')
         imagelist = []
+        dataset_index = DatasetIndex(fip_images=fip_images)
         
         #fip_references = fip_references[0:10]
         
         for fip_ref in fip_references:
             image = Image(fip_ref=fip_ref, settings=self.settings)
             image.fip_ref = fip_ref
-            image.findImage(fip_images, dataset=self.settings['DATASET'])
+            image.findImage(dataset_index, dataset=self.settings['DATASET'])
             imagelist.append(image)
         return imagelist
 
     def filterSliceThickness(self, imagelistExp):
 
-        filepath_slice_step = self.settings['filepath_slice_step']
+        slice_step_index = self.get_slice_step_index()
         imagelistExp_filt=[]
         for image in imagelistExp:
             fip_ref = image.fip_ref
             _,fname,_ = splitFilePath(fip_ref)
             series_image = fname.split('_')[1].split('-')[0]
-            slice_thickness = None
-            with io.open(filepath_slice_step, 'r', encoding='utf-8-sig') as read_obj:
-                csv_reader = reader(read_obj)
-                for row in csv_reader:
-                    series = row[2]
-                    if series_image==series:
-                        try:
-                            slice_thickness = float(row[4])
-                            if slice_thickness>3.0 or slice_thickness<2.4:
-                                slice_thickness=None
-                        except ValueError:
-                            slice_thickness=None
-                if slice_thickness is not None:
-                    imagelistExp_filt.append(image)
+            slice_thickness = slice_step_index.slice_thickness(series_image)
+            if slice_thickness is not None and slice_thickness<=3.0 and slice_thickness>=2.4:
+                imagelistExp_filt.append(image)
+            elif slice_thickness is None:
+                print('Image ' + image.image_name + ' has no slice thickness in slice_step csv file!')
         return imagelistExp_filt
         
 
@@ -619,10 +705,7 @@ class CACSLabelerModuleWidget:
 
     def filter_by_reference(self, filepaths, filepaths_ref, filter_reference_with, filter_reference_without):
         
-        refname_list=[]
-        for f in filepaths_ref:
-            _,fname,_ = splitFilePath(f)
-            refname_list.append(fname)
+        reference_index = DatasetIndex(fip_references=filepaths_ref)
         filenames_filt=[]
         for f in filepaths:
             _,fname,_ = splitFilePath(f)
@@ -630,15 +713,13 @@ class CACSLabelerModuleWidget:
             if len(filter_reference_with)>0:
                 check_with = False
                 for x in filter_reference_with:
-                    refname_with = fname + x
-                    check_with = check_with or refname_with in refname_list
+                    check_with = check_with or reference_index.hasReference(fname, x)
             else:
                 check_with = True
             # Check filter_reference_without
             check_without=True
             for x in filter_reference_without:
-                refname_without = fname + x
-                check_without = check_without and refname_without not in refname_list
+                check_without = check_without and not reference_index.hasReference(fname, x)
             if check_with and check_without:
                 #print('in')
                 filenames_filt.append(f)
@@ -667,9 +748,10 @@ class CACSLabelerModuleWidget:
             filter_reference_without = self.settings['filter_reference_without']
             files = self.filter_by_reference(files, filepaths_label_ref, filter_reference_with, filter_reference_without)
             filter_input_ref = ''
+            reference_index = DatasetIndex(fip_references=files_ref)
             for f in files:
                 _,fname,_ = splitFilePath(f)
-                ref_found = any([fname in ref for ref in files_ref])
+                ref_found = reference_index.referenceFound(fname)
                 if ref_found and self.settings['show_input_if_ref_found']:
                     filter_input_ref = filter_input_ref + fname + '.mhd '
                 if not ref_found and self.settings['show_input_if_ref_not_found']:
@@ -724,7 +806,8 @@ class CACSLabelerModuleWidget:
                         
         
         # Threshold image
-        self.CACSLabelerModuleLogic = CACSLabelerModuleLogic(self.KEV80.checked, self.KEV120.checked, inputVolumeName)
+        self.CACSLabelerModuleLogic = CACSLabelerModuleLogic(self.KEV80.checked, self.KEV120.checked, inputVolumeName,
+                                                             self.settings.settingsDict.get('lowerThresholdValue_KEV80'))
         self.CACSLabelerModuleLogic.runThreshold()
         self.CACSLabelerModuleLogic.setLowerPaintThreshold()
 
@@ -802,12 +885,14 @@ class CACSLabelerModuleLogic:
     this class and make use of the functionality without
     requiring an instance of the Widget
     """
-    def __init__(self, KEV80=False, KEV120=False, inputVolumeName=None):
+    def __init__(self, KEV80=False, KEV120=False, inputVolumeName=None, lowerThresholdValueKEV80=None):
         self.lowerThresholdValue = lowerThresholdValue
         self.upperThresholdValue = upperThresholdValue
         self.editUtil = EditorLib.EditUtil.EditUtil()
         self.KEV80 = KEV80
         self.KEV120 = KEV120
+        # protocol specific threshold for 80 KEV images, settings key lowerThresholdValue_KEV80
+        self.lowerThresholdValueKEV80 = lowerThresholdValueKEV80
         self.inputVolumeName = inputVolumeName
         self.calciumLabelNode = None
         self.CardiacAgatstonMeasuresLUTNode = None
@@ -817,7 +902,12 @@ class CACSLabelerModuleLogic:
 
         # Sets minimum threshold value based on KEV80 or KEV120
         if self.KEV80:
-            print('!!! Method for KEV80 not implemented !!!')
+            if self.lowerThresholdValueKEV80 is None:
+                print('No lowerThresholdValue_KEV80 in settings, using the 120 KEV threshold')
+                self.lowerThresholdValue = lowerThresholdValue
+            else:
+                self.lowerThresholdValue = self.lowerThresholdValueKEV80
+            self.upperThresholdValue = upperThresholdValue
             calciumName = "{0}-label-lesion".format(self.inputVolumeName)
         elif self.KEV120:
             self.lowerThresholdValue = lowerThresholdValue
@@ -9,6 +9,7 @@ import SimpleITK as sitk
 import time
 import csv
 from CalciumScores.CalciumScoreBase import CalciumScoreBase
+from CalciumScores.LesionAnalysis import LesionAnalysis
 import time
 
 #def componentAnalysis(ref_sitk):
@@ -29,10 +30,22 @@ class Agatston(CalciumScoreBase):
     
     name = 'AGATSTON_SCORE'
     
-    def __init__(self):
+    def __init__(self, threshold=130, densityBands=None):
         #CalciumScoreBase.__init__(self) 
         self.agatston = None
         self.arteries = ['LAD', 'LCX', 'RCA']
+        self.threshold = threshold
+        # Custom density bands [(lower HU bound, weight), ...], the default weights are used if None
+        if densityBands is not None:
+            densityBands = sorted((bound, weight) for bound, weight in densityBands)
+            if len(densityBands)==0:
+                raise ValueError('Agatston density bands are empty.')
+            bounds = [bound for bound, weight in densityBands]
+            if len(set(bounds))<len(bounds):
+                raise ValueError('Agatston density bands contain duplicate bounds.')
+            if any(weight<0 for bound, weight in densityBands):
+                raise ValueError('Agatston density band weights must not be negative.')
+        self.densityBands = densityBands
 
     def densityFactor(self, value):
         """ Compute density weigt factor for agatston score based on maximum HU value of a lesion
@@ -40,9 +53,16 @@ class Agatston(CalciumScoreBase):
         :param value: Maximum HU value of a lesion
         :type value: int
         """
-        if value<130:
+        if value<self.threshold:
+            return 0
+        if self.densityBands is not None:
+            # Weight of the highest band whose lower bound is reached
             densfactor=0
-        elif value>=130 and value<=199:
+            for bound, weight in self.densityBands:
+                if value>=bound:
+                    densfactor=weight
+            return densfactor
+        if value<=199:
             densfactor=1
         elif value>199 and value<=299:
             densfactor=2
@@ -70,7 +90,7 @@ class Agatston(CalciumScoreBase):
             grading='zero'
         return grading
 
-    def compute(self, inputVolume, inputVolumeLabel, arteries_dict={}, arteries_sum={}, slice_step=1, slice_thickness=3.0):
+    def compute(self, inputVolume, inputVolumeLabel, arteries_dict={}, arteries_sum={}, slice_step=1, slice_thickness=3.0, analysis=None):
         """ Compute agatston score from image and image label
 
         :param image: Image
@@ -79,56 +99,32 @@ class Agatston(CalciumScoreBase):
         :type imageLabel: np.ndarray
         :param pixelVolume: Volume of apixel
         :type pixelVolume: float
+        :param analysis: Lesion analysis of the image shared with other scores, created if None
+        :type analysis: LesionAnalysis
         """
         
         if arteries_dict is not None:
             self.arteries_dict = arteries_dict
 
-        image_np = sitk.GetArrayFromImage(inputVolume)
-        imageLabel_np = sitk.GetArrayFromImage(inputVolumeLabel)
-        spacing = inputVolume.GetSpacing()
+        if analysis is None:
+            analysis = LesionAnalysis(inputVolume, inputVolumeLabel)
+        spacing = analysis.spacing
         pixelArea = spacing[0]*spacing[1]
         arteries_sum_keys = list(arteries_sum.keys())
 
         # Iterate over arteries
         agatston = OrderedDict([('NAME', self.name), ('AgatstonScore', 0), ('Grading', None)])
         for key in self.arteries_dict.keys():
-            # Extract binary mask of lesions from one artery
-            imageLabelA_np = imageLabel_np==self.arteries_dict[key]
-            if imageLabelA_np.sum()>0:
-                #imageLabelA_sitk = sitk.GetImageFromArray(imageLabelA_np.astype(np.uint8))
-                
-                agatstonArtery = 0
-                
-                # Iterate over slices
-                for s in range(0,imageLabelA_np.shape[0], slice_step):
-                    image_slice_np = image_np[s,:,:]
-                    label_slice_np = imageLabelA_np[s,:,:]
+            # Lesions of one artery
+            if analysis.hasLesions(self.arteries_dict[key]):
+                counts, attenuations = analysis.sliceLesions(self.arteries_dict[key], slice_step)
 
-                    # Extract connected components
-                    label_slice_sitk = sitk.GetImageFromArray(label_slice_np.astype(np.uint8))
-                    compFilter = ConnectedComponentImageFilter()
-                    labeled_sitk = compFilter.Execute(label_slice_sitk)
-                    labeled = sitk.GetArrayFromImage(labeled_sitk)
-                    ncomponents = labeled.max()
-                    
-                    # Iterate over lesions from an artery
-                    for c in range(1,ncomponents+1):
-                        labeledc_comp = labeled==c
-                        image_mask_slice_np = image_slice_np * labeledc_comp
-                        
-                        # Extract maximum HU of a lesion
-                        attenuation = image_mask_slice_np.max()
-                        area = labeledc_comp.sum() * pixelArea
-                        # Calculate density weigt factor
-                        densfactor = self.densityFactor(attenuation)
-                        # Calculate agatston score for a lesion
-                        agatstonLesionSlice = area * densfactor
-                        # Scale agatston score based on slice_thickness
-                        ratio = slice_thickness/3.0
-                        agatstonLesionSlice = agatstonLesionSlice * ratio
-                        # Sum agatston score over slices
-                        agatstonArtery = agatstonArtery + agatstonLesionSlice
+                agatstonArtery = 0
+                ratio = slice_thickness/3.0
+                for count, attenuation in zip(counts, attenuations):
+                    # Calculate agatston score for a lesion scaled by slice_thickness and sum over slices
+                    agatstonLesionSlice = count * pixelArea * self.densityFactor(attenuation)
+                    agatstonArtery = agatstonArtery + agatstonLesionSlice * ratio
 
                 agatston[key] = agatstonArtery
             else:
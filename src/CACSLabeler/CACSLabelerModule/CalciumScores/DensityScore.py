@@ -9,19 +9,23 @@ from Agatston import Agatston
 from VolumeScore import VolumeScore
 import csv
 from CalciumScores.CalciumScoreBase import CalciumScoreBase
+from CalciumScores.LesionAnalysis import LesionAnalysis
 
 # DensityScore
 class DensityScore(CalciumScoreBase):
     
     name = 'DENSITY_SCORE'
     
-    def __init__(self):
+    def __init__(self, threshold=130, densityBands=None):
         #CalciumScoreBase.__init__(self) 
         self.DensityScore = None
         self.arteries = ['LAD', 'LCX', 'RCA']
+        # Parameters of the inner Agatston score
+        self.threshold = threshold
+        self.densityBands = densityBands
 
         
-    def compute(self, inputVolume, inputVolumeLabel,  arteries_dict={}, arteries_sum={}):
+    def compute(self, inputVolume, inputVolumeLabel,  arteries_dict={}, arteries_sum={}, slice_step=1, slice_thickness=3.0, analysis=None):
         """ Compute agatston score from image and image label
 
         :param image: Image
@@ -30,15 +34,20 @@ class DensityScore(CalciumScoreBase):
         :type imageLabel: np.ndarray
         :param pixelVolume: Volume of apixel
         :type pixelVolume: float
+        :param analysis: Lesion analysis of the image shared with other scores, created if None
+        :type analysis: LesionAnalysis
         """
         if arteries_dict is not None:
             self.arteries_dict = arteries_dict
             
-        agatston = Agatston()
+        if analysis is None:
+            analysis = LesionAnalysis(inputVolume, inputVolumeLabel)
+        # Agatston and volume score reuse the lesions of the analysis
+        agatston = Agatston(self.threshold, self.densityBands)
         volumeScore = VolumeScore()
-        score_agatston = agatston.compute(inputVolume, inputVolumeLabel, arteries_dict)
-        score_volumeScore = volumeScore.compute(inputVolume, inputVolumeLabel, arteries_dict)
-        spacing = inputVolume.GetSpacing()
+        score_agatston = agatston.compute(inputVolume, inputVolumeLabel, arteries_dict, analysis=analysis)
+        score_volumeScore = volumeScore.compute(inputVolume, inputVolumeLabel, arteries_dict, analysis=analysis)
+        spacing = analysis.spacing
         sliceThickness = spacing[2]
         arteries_sum_keys = list(arteries_sum.keys())
         
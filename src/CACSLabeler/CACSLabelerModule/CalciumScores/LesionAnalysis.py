@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from SimpleITK import ConnectedComponentImageFilter
+import SimpleITK as sitk
+from scipy import ndimage
+
+# 4-connectivity within a slice like ConnectedComponentImageFilter on a 2D slice, no connection between slices
+sliceConnectivity = np.zeros((3, 3, 3), dtype=bool)
+sliceConnectivity[1] = ndimage.generate_binary_structure(2, 1)
+
+# Lesion analysis of one image, shared by all calcium scores of the image
+class LesionAnalysis:
+
+    def __init__(self, inputVolume, inputVolumeLabel):
+        self.image = sitk.GetArrayFromImage(inputVolume)
+        self.imageLabel = sitk.GetArrayFromImage(inputVolumeLabel)
+        self.spacing = inputVolume.GetSpacing()
+        # Computed once per label value (and slice_step)
+        self.voxelsCache = {}
+        self.componentsCache = {}
+        self.lesionStatisticsCache = {}
+        self.sliceLesionsCache = {}
+
+    def voxels(self, value):
+        """ Flat indices of the voxels with a label value in raster order
+
+        :param value: Label value of an artery
+        :type value: int
+        """
+        if value not in self.voxelsCache:
+            self.voxelsCache[value] = np.flatnonzero(self.imageLabel==value)
+        return self.voxelsCache[value]
+
+    def hasLesions(self, value):
+        return self.voxels(value).size > 0
+
+    def values(self, value):
+        # HU values of the voxels of a label value, same order as voxels
+        return self.image.ravel()[self.voxels(value)]
+
+    def boundingBox(self, value):
+        # (positions of the voxels, first and last+1 index per axis)
+        positions = np.unravel_index(self.voxels(value), self.imageLabel.shape)
+        return positions, [(p.min(), p.max()+1) for p in positions]
+
+    def mask(self, value):
+        # Binary mask of a label value cropped to its bounding box
+        positions, box = self.boundingBox(value)
+        mask = np.zeros([stop-start for start, stop in box], dtype=bool)
+        mask[tuple(p-start for p, (start, stop) in zip(positions, box))] = True
+        return mask, box
+
+    def components(self, value):
+        """ 3D connected components of a label value
+
+        Returns the component of every voxel (same order as voxels) and the number of components.
+
+        :param value: Label value of an artery
+        :type value: int
+        """
+        if value not in self.componentsCache:
+            mask, _ = self.mask(value)
+            compFilter = ConnectedComponentImageFilter()
+            labeled = sitk.GetArrayFromImage(compFilter.Execute(sitk.GetImageFromArray(mask.astype(np.uint8))))
+            # Boolean indexing of the cropped mask keeps the raster order of voxels
+            self.componentsCache[value] = (labeled[mask], int(labeled.max()))
+        return self.componentsCache[value]
+
+    def lesionStatistics(self, value):
+        """ Voxel count and HU sum of every 3D lesion of a label value, ordered by component
+
+        :param value: Label value of an artery
+        :type value: int
+        """
+        if value not in self.lesionStatisticsCache:
+            labeled, ncomponents = self.components(value)
+            counts = np.bincount(labeled, minlength=ncomponents+1)[1:]
+            huSums = np.bincount(labeled, weights=self.values(value), minlength=ncomponents+1)[1:]
+            self.lesionStatisticsCache[value] = (counts, huSums)
+        return self.lesionStatisticsCache[value]
+
+    def sliceLesions(self, value, slice_step=1):
+        """ Lesions of a label value on every slice_step-th slice
+
+        Returns the area in pixels and the maximum HU of every lesion, ordered by slice and raster order within a slice.
+
+        :param value: Label value of an artery
+        :type value: int
+        :param slice_step: Step between scored slices, starting with the first slice
+        :type slice_step: int
+        """
+        if (value, slice_step) not in self.sliceLesionsCache:
+            mask, box = self.mask(value)
+            # The first scored slice stays a multiple of slice_step
+            firstSlice = -(-box[0][0] // slice_step) * slice_step
+            region = (slice(firstSlice, box[0][1], slice_step), slice(*box[1]), slice(*box[2]))
+
+            # Label the lesions of all scored slices at once, components only connect within a slice
+            labeled, ncomponents = ndimage.label(mask[firstSlice-box[0][0]::slice_step], structure=sliceConnectivity)
+            lesionVoxels = labeled > 0
+            lesionLabels = labeled[lesionVoxels]
+            counts = np.bincount(lesionLabels, minlength=ncomponents+1)[1:]
+            if ncomponents > 0:
+                attenuations = np.asarray(ndimage.maximum(self.image[region][lesionVoxels], lesionLabels, np.arange(1, ncomponents+1)))
+            else:
+                # lesions only on slices skipped by slice_step
+                attenuations = np.zeros(0, dtype=self.image.dtype)
+            # The maximum of the former per slice computation was taken over the masked slice, which contains zeros outside of the lesion
+            sliceSize = self.imageLabel.shape[1] * self.imageLabel.shape[2]
+            attenuations = np.where(counts < sliceSize, np.maximum(attenuations, 0), attenuations)
+            self.sliceLesionsCache[(value, slice_step)] = (counts, attenuations)
+        return self.sliceLesionsCache[(value, slice_step)]
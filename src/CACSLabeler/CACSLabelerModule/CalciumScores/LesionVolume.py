@@ -9,6 +9,10 @@ import SimpleITK as sitk
 import time
 import csv
 from CalciumScores.CalciumScoreBase import CalciumScoreBase
+from CalciumScores.LesionAnalysis import LesionAnalysis
+
+# One row per lesion
+lesionTableDtype = np.dtype([('LesionID', np.int64), ('NumVoxels', np.int64), ('LesionVolume', np.float64), ('HUSum', np.float64)])
 
 # Agatston score
 class LesionVolume(CalciumScoreBase):
@@ -20,7 +24,7 @@ class LesionVolume(CalciumScoreBase):
         self.lesvolume = None
         #self.arteries = ['LAD', 'LCX', 'RCA']
 
-    def compute(self, inputVolume, inputVolumeLabel, arteries_dict={}, arteries_sum={}):
+    def compute(self, inputVolume, inputVolumeLabel, arteries_dict={}, arteries_sum={}, slice_step=1, slice_thickness=3.0, analysis=None):
         """ Compute agatston score from image and image label
 
         :param image: Image
@@ -29,14 +33,16 @@ class LesionVolume(CalciumScoreBase):
         :type imageLabel: np.ndarray
         :param pixelVolume: Volume of apixel
         :type pixelVolume: float
+        :param analysis: Lesion analysis of the image shared with other scores, created if None
+        :type analysis: LesionAnalysis
         """
         
         if arteries_dict is not None:
             self.arteries_dict = arteries_dict
 
-        image = sitk.GetArrayFromImage(inputVolume)
-        imageLabel = sitk.GetArrayFromImage(inputVolumeLabel)
-        spacing = inputVolume.GetSpacing()
+        if analysis is None:
+            analysis = LesionAnalysis(inputVolume, inputVolumeLabel)
+        spacing = analysis.spacing
         pixelVolume = spacing[0]*spacing[1]*spacing[2]
         arteries_sum_keys = list(arteries_sum.keys())
 
@@ -54,34 +60,23 @@ class LesionVolume(CalciumScoreBase):
         lesvolume = OrderedDict([('NAME', self.name)])
         for key in self.arteries_dict.keys():
             #if key not in arteries_sum_keys:
-                # Extract binary mask of lesions from one artery
-            imageLabelA = imageLabel==self.arteries_dict[key]
-            if imageLabelA.sum()>0:
-                image_sitk = sitk.GetImageFromArray(imageLabelA.astype(np.uint8))
-                # Extract connected components
-                compFilter = ConnectedComponentImageFilter()
-                labeled_sitk = compFilter.Execute(image_sitk)
-                labeled = sitk.GetArrayFromImage(labeled_sitk)
-                ncomponents = labeled.max()
+            # Connected components of the lesions from one artery
+            if analysis.hasLesions(self.arteries_dict[key]):
+                counts, huSums = analysis.lesionStatistics(self.arteries_dict[key])
 
-                # Iterate over lesions from an artery
-                volumeList=[]
-                for c in range(1,ncomponents+1):
-                    labeledc = labeled==c
-                    image_mask = image * labeledc
-                    NumPixels = image_mask.sum()
-                    volume = NumPixels * pixelVolume
-                    volumeList.append({'LesionID': c, 'LesionVolume': volume})
-                lesvolume[key] = volumeList
+                # Table of the lesions from an artery
+                table = np.zeros(len(counts), dtype=lesionTableDtype)
+                table['LesionID'] = np.arange(1, len(counts)+1)
+                table['NumVoxels'] = counts
+                table['LesionVolume'] = counts * pixelVolume
+                table['HUSum'] = huSums
+                lesvolume[key] = table
             else:
-                lesvolume[key] = 0.0
+                lesvolume[key] = np.zeros(0, dtype=lesionTableDtype)
 
-        # Sum agatston score over arteries_sum
+        # Combine the lesions of arteries_sum
         for key in arteries_sum_keys:
-            value = 0
-            for key_sum in arteries_sum[key]:
-                value += lesvolume[key_sum]
-            lesvolume[key] = value
+            lesvolume[key] = np.concatenate([lesvolume[key_sum] for key_sum in arteries_sum[key]])
 
         # Sum agatston score over arteries_sum
 #        for key in arteries_sum_keys:
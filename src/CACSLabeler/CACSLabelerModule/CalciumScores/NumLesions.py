@@ -9,6 +9,7 @@ import SimpleITK as sitk
 import time
 import csv
 from CalciumScores.CalciumScoreBase import CalciumScoreBase
+from CalciumScores.LesionAnalysis import LesionAnalysis
 
 # Agatston score
 class NumLesions(CalciumScoreBase):
@@ -21,7 +22,7 @@ class NumLesions(CalciumScoreBase):
         self.arteries = ['LAD', 'LCX', 'RCA']
 
 
-    def compute(self, inputVolume, inputVolumeLabel, arteries_dict={}, arteries_sum={}):
+    def compute(self, inputVolume, inputVolumeLabel, arteries_dict={}, arteries_sum={}, slice_step=1, slice_thickness=3.0, analysis=None):
         """ Compute agatston score from image and image label
 
         :param image: Image
@@ -30,12 +31,15 @@ class NumLesions(CalciumScoreBase):
         :type imageLabel: np.ndarray
         :param pixelVolume: Volume of apixel
         :type pixelVolume: float
+        :param analysis: Lesion analysis of the image shared with other scores, created if None
+        :type analysis: LesionAnalysis
         """
         
         if arteries_dict is not None:
             self.arteries_dict = arteries_dict
 
-        imageLabel = sitk.GetArrayFromImage(inputVolumeLabel)
+        if analysis is None:
+            analysis = LesionAnalysis(inputVolume, inputVolumeLabel)
         arteries_sum_keys = list(arteries_sum.keys())
 
         # Neighborhood of connected components (6-connectivity)
@@ -52,15 +56,9 @@ class NumLesions(CalciumScoreBase):
         number = OrderedDict([('NAME', self.name), ('AgatstonScore', 0), ('Grading', None)])
         for key in self.arteries_dict.keys():
             if key not in arteries_sum_keys:
-                # Extract binary mask of lesions from one artery
-                imageLabelA = imageLabel==self.arteries_dict[key]
-                if imageLabelA.sum()>0:
-                    image_sitk = sitk.GetImageFromArray(imageLabelA.astype(np.uint8))
-                    # Extract connected components
-                    compFilter = ConnectedComponentImageFilter()
-                    labeled_sitk = compFilter.Execute(image_sitk)
-                    labeled = sitk.GetArrayFromImage(labeled_sitk)
-                    ncomponents = labeled.max()
+                # Connected components of the lesions from one artery
+                if analysis.hasLesions(self.arteries_dict[key]):
+                    _, ncomponents = analysis.components(self.arteries_dict[key])
                     number[key] = int(ncomponents)
                 else:
                     number[key] = 0
@@ -8,6 +8,7 @@ from SimpleITK import ConnectedComponentImageFilter
 import SimpleITK as sitk
 import csv
 from CalciumScores.CalciumScoreBase import CalciumScoreBase
+from CalciumScores.LesionAnalysis import LesionAnalysis
 
 # VolumeScore
 class VolumeScore(CalciumScoreBase):
@@ -18,7 +19,7 @@ class VolumeScore(CalciumScoreBase):
         self.VolumeScore = None
         self.arteries = ['LAD', 'LCX', 'RCA']
        
-    def compute(self, inputVolume, inputVolumeLabel, arteries_dict=None, arteries_sum={}):
+    def compute(self, inputVolume, inputVolumeLabel, arteries_dict=None, arteries_sum={}, slice_step=1, slice_thickness=3.0, analysis=None):
         """ Compute agatston score from image and image label
 
         :param image: Image
@@ -27,12 +28,15 @@ class VolumeScore(CalciumScoreBase):
         :type imageLabel: np.ndarray
         :param pixelVolume: Volume of apixel
         :type pixelVolume: float
+        :param analysis: Lesion analysis of the image shared with other scores, created if None
+        :type analysis: LesionAnalysis
         """
         if arteries_dict is not None:
             self.arteries_dict = arteries_dict
             
-        imageLabel = sitk.GetArrayFromImage(inputVolumeLabel)
-        spacing = inputVolume.GetSpacing()
+        if analysis is None:
+            analysis = LesionAnalysis(inputVolume, inputVolumeLabel)
+        spacing = analysis.spacing
         pixelVolume = spacing[0]*spacing[1]*spacing[2]
         arteries_sum_keys = list(arteries_sum.keys())
 
@@ -52,21 +56,12 @@ class VolumeScore(CalciumScoreBase):
         #for k, key in enumerate(self.arteries):
         for key in self.arteries_dict.keys():
             if key not in arteries_sum_keys:
-                # Extract binary mask of lesions from one artery
-                imageLabelA = imageLabel==self.arteries_dict[key]
-                if imageLabelA.sum()>0:
-                    image_sitk = sitk.GetImageFromArray(imageLabelA.astype(np.uint8))
-                    # Extract connected components
-                    compFilter = ConnectedComponentImageFilter()
-                    labeled_sitk = compFilter.Execute(image_sitk)
-                    labeled = sitk.GetArrayFromImage(labeled_sitk)
-                    ncomponents = labeled.max()
+                # Connected components of the lesions from one artery
+                if analysis.hasLesions(self.arteries_dict[key]):
+                    counts, _ = analysis.lesionStatistics(self.arteries_dict[key])
                     VolumeScoreArtery = 0
-                    # Iterate over lesions from an artery
-                    for c in range(1,ncomponents+1):
-                        labeledc = labeled==c
-                        volume = labeledc.sum() * pixelVolume
-                        # Calculate agatston score for a lesion
+                    # Sum the lesion volumes in lesion order
+                    for volume in counts * pixelVolume:
                         VolumeScoreArtery = VolumeScoreArtery + volume
                     VolumeScore[key] = VolumeScoreArtery
                 else: